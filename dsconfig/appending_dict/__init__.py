@@ -1,8 +1,8 @@
-from collections import defaultdict, Mapping
-from .caseless import CaselessDictionary
+from collections import Mapping
+from .caseless import CaselessDictionary, CaselessMixin, _lower
 
 
-class SetterDict(CaselessDictionary, defaultdict):
+class SetterDict(CaselessMixin, dict):
     """
     A recursive defaultdict with extra bells & whistles
 
@@ -25,47 +25,72 @@ class SetterDict(CaselessDictionary, defaultdict):
     result in creating it, which means that confusing behavior is
     likely. Please use it carefully and convert to an ordinary dict
     (using to_dict()) when you're done creating it.
+
+    Nodes use __slots__ so that large trees stay reasonably compact.
+    The items are kept in the CaselessMixin storage, not in the dict
+    itself; the dict base class is only there for isinstance checks.
     """
 
+    __slots__ = ("_data", "_factory")
+
     def __init__(self, value={}, factory=None):
-        factory = factory or SetterDict
-        self.__dict__["_factory"] = factory
-        CaselessDictionary.__init__(self)
-        defaultdict.__init__(self, factory)
+        object.__setattr__(self, "_data", {})
+        object.__setattr__(self, "_factory", factory or type(self))
         for k, v in value.items():
             self[k] = v
 
+    def __missing__(self, key):
+        child = self._factory()
+        self[key] = child
+        return child
+
     def __getitem__(self, key):
-        try:
-            return CaselessDictionary.__getitem__(self, key)
-        except KeyError:
+        item = self._data.get(_lower(key))
+        if item is None:
             return self.__missing__(key)
+        return item[1]
 
     def __setitem__(self, key, value):
-        if isinstance(value, SetterDict):
-            CaselessDictionary.__setitem__(self, key, value)
-        elif isinstance(value, Mapping):
-            CaselessDictionary.__setitem__(self, key, self._factory(value))
-        else:
-            CaselessDictionary.__setitem__(self, key, value)
+        if isinstance(value, Mapping) and not isinstance(value, SetterDict):
+            value = self._factory(value)
+        CaselessMixin.__setitem__(self, key, value)
 
     def __getattr__(self, name):
+        if name.startswith("__"):
+            # don't pretend to have special methods (copy, pickle...)
+            raise AttributeError(name)
         return self.__getitem__(name)
 
     def __setattr__(self, key, value):
         return self.__setitem__(key, value)
 
-    def to_dict(self):
-        """Returns a ordinary dict version of itself"""
+    def __reduce__(self):
+        return self.__class__, (self.to_dict(),)
+
+    def to_dict(self, consume=False):
+        """Returns a ordinary dict version of itself. With 'consume',
+        each node is emptied once converted, which keeps the peak memory
+        down when the tree is not needed afterwards."""
         result = {}
-        for key, value in self.items():
-            if isinstance(value, SetterDict):
-                result[key] = value.to_dict()
-            else:
-                result[key] = value
+        stack = [(self, result)]
+        while stack:
+            node, converted = stack.pop()
+            for key, value in node._data.itervalues():
+                if isinstance(value, SetterDict):
+                    converted[key] = {}
+                    stack.append((value, converted[key]))
+                else:
+                    converted[key] = value
+            if consume:
+                node._data.clear()
         return result
 
 
+# SetterDicts are caseless dictionaries, even if they don't inherit
+# from CaselessDictionary
+CaselessDictionary.register(SetterDict)
+
+
 def merge(d, u):
     "Recursively 'merge' a Mapping into another"
     for k, v in u.iteritems():
@@ -118,6 +143,8 @@ class AppendingDict(SetterDict):
 
     """
 
+    __slots__ = ()
+
     def __init__(self, value={}):
         SetterDict.__init__(self, value, AppendingDict)
 
@@ -126,15 +153,16 @@ class AppendingDict(SetterDict):
 
     def __setitem__(self, attr, value):
         # I apologize for this method :(
-        if attr in self:
-            if isinstance(self[attr], AppendingDict):
+        item = self._data.get(_lower(attr))
+        if item is not None:
+            if isinstance(item[1], AppendingDict):
                 if isinstance(value, Mapping):
-                    merge(self[attr], value)
+                    merge(item[1], value)
                 else:
                     raise ValueError("Can't overwrite a subtree "
                                      "with a scalar value.")
             else:
-                self[attr].extend(list_of_strings(value))
+                item[1].extend(list_of_strings(value))
         else:
             if isinstance(value, Mapping):
                 if isinstance(value, AppendingDict):
@@ -143,3 +171,38 @@ class AppendingDict(SetterDict):
                     self._set(attr, AppendingDict(value))
             else:
                 self._set(attr, list_of_strings(value))
+
+    def extend_rows(self, rows):
+        """Add a lot of values at once. Each row is a tuple of keys,
+        one per level, ending with a single value to append, e.g.
+
+          a.extend_rows([("dev", "properties", "prop", "value"), ...])
+
+        is the same as doing a["dev"]["properties"]["prop"] = "value"
+        for each row, but a lot cheaper for large amounts of rows."""
+        for row in rows:
+            node = self
+            last = len(row) - 2
+            for i in xrange(last):
+                key = row[i]
+                lower = _lower(key)
+                item = node._data.get(lower)
+                if item is None:
+                    child = AppendingDict()
+                    node._data[lower] = (key, child)
+                    node = child
+                else:
+                    node = item[1]
+                    if not isinstance(node, AppendingDict):
+                        raise ValueError("Can't add a subtree to a "
+                                         "scalar value.")
+            key = row[last]
+            lower = _lower(key)
+            item = node._data.get(lower)
+            if item is None:
+                node._data[lower] = (key, [str(row[-1])])
+            elif isinstance(item[1], AppendingDict):
+                raise ValueError("Can't overwrite a subtree "
+                                 "with a scalar value.")
+            else:
+                item[1].append(str(row[-1]))
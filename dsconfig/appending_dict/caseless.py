@@ -1,9 +1,135 @@
 """A caseless dictionary implementation."""
 
-from collections import MutableMapping
+from collections import (Mapping, MutableMapping,
+                         KeysView, ValuesView, ItemsView)
 
 
-class CaselessDictionary(MutableMapping):
+def _lower(key):
+    if isinstance(key, basestring):
+        return key.lower()
+    return key
+
+
+class CaselessMixin(object):
+
+    """
+    The implementation of CaselessDictionary. It has no instance layout
+    of its own, so that it can also be used for classes with __slots__,
+    or that inherit from dict (see SetterDict). The class must provide
+    an ordinary dict as the attribute "_data".
+
+    Internally, the items are stored in the "_data" dict, mapping the
+    lowercased key to the original key and the value. That way a lookup
+    is just a single dict lookup.
+    """
+
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        return self._data[_lower(key)][1]
+
+    def __setitem__(self, key, value):
+        lower = _lower(key)
+        item = self._data.get(lower)
+        self._data[lower] = (key if item is None else item[0], value)
+
+    def __delitem__(self, key):
+        del self._data[_lower(key)]
+
+    def __contains__(self, key):
+        return _lower(key) in self._data
+
+    def __iter__(self):
+        for key, _ in self._data.itervalues():
+            yield key
+
+    def __len__(self):
+        return len(self._data)
+
+    def __eq__(self, other):
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        return dict(self.iteritems()) == dict(other.items())
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, dict(self.iteritems()))
+
+    def has_key(self, key):
+        return key in self
+
+    def get(self, key, default=None):
+        item = self._data.get(_lower(key))
+        if item is None:
+            return default
+        return item[1]
+
+    def keys(self):
+        return [key for key, _ in self._data.itervalues()]
+
+    def values(self):
+        return [value for _, value in self._data.itervalues()]
+
+    def items(self):
+        return self._data.values()
+
+    def iterkeys(self):
+        return iter(self)
+
+    def itervalues(self):
+        for _, value in self._data.itervalues():
+            yield value
+
+    def iteritems(self):
+        return self._data.itervalues()
+
+    def viewkeys(self):
+        return KeysView(self)
+
+    def viewvalues(self):
+        return ValuesView(self)
+
+    def viewitems(self):
+        return ItemsView(self)
+
+    def update(self, *args, **kwargs):
+        # Note: we can't use dict() on the arguments, since it does not
+        # work for dict subclasses that keep their items elsewhere.
+        for other in args + (kwargs,):
+            if isinstance(other, Mapping):
+                other = other.items()
+            for key, value in other:
+                self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        try:
+            return self._data.pop(_lower(key))[1]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+
+    def popitem(self):
+        return self._data.popitem()[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def copy(self):
+        return type(self)(self)
+
+
+class CaselessDictionary(CaselessMixin, MutableMapping):
 
     """
     A dictionary-like object which ignores but preserves the case of strings.
@@ -42,62 +168,13 @@ class CaselessDictionary(MutableMapping):
     """
 
     def __init__(self, *args, **kwargs):
-        self.__dict__["_dict"] = {}
-        temp_dict = dict(*args, **kwargs)
-        for key, value in temp_dict.iteritems():
-            if isinstance(key, basestring):
-                key = CaselessString.make_caseless(key)
-            self._dict[key] = value
-
-    def __getitem__(self, key):
-        return self._dict[CaselessString.make_caseless(key)]
-
-    def __setitem__(self, key, value):
-        self._dict[CaselessString.make_caseless(key)] = value
-
-    def __delitem__(self, key):
-        del self._dict[CaselessString.make_caseless(key)]
-
-    def __contains__(self, key):
-        return CaselessString.make_caseless(key) in self._dict
-
-    def __iter__(self):
-        return iter(self._dict)
-
-    def __len__(self):
-        return len(self._dict)
-
-    def keys(self):
-        # convert back to ordinary strings
-        return [str(k) for k in self._dict]
-
-    def items(self):
-        return zip(self.keys(), self.values())
-
-
-class CaselessString(object):
-
-    """A mixin to make a string subclass case-insensitive in dict lookups."""
-
-    def __hash__(self):
-        return hash(self.lower())
-
-    def __eq__(self, other):
-        return self.lower() == other.lower()
-
-    def __cmp__(self, other):
-        return self.lower().__cmp__(other.lower())
-
-    @classmethod
-    def make_caseless(cls, string):
-        if isinstance(string, unicode):
-            return CaselessUnicode(string)
-        return CaselessStr(string)
-
-
-class CaselessStr(CaselessString, str):
-    pass
+        self.__dict__["_data"] = {}
+        self.update(*args, **kwargs)
 
 
-class CaselessUnicode(CaselessString, unicode):
-    pass
+def caseless_tree(data):
+    """Make a CaselessDictionary out of a nested dict, converting all
+    levels (i.e. all values that are Mappings)."""
+    return CaselessDictionary(
+        (key, caseless_tree(value) if isinstance(value, Mapping) else value)
+        for key, value in data.items())
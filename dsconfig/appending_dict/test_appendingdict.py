@@ -3,7 +3,9 @@ try:
 except:
     import unittest
 
+import pickle
 from . import SetterDict, AppendingDict, merge
+from .caseless import CaselessDictionary, caseless_tree
 
 
 class MergeTestCase(unittest.TestCase):
@@ -21,6 +23,31 @@ class MergeTestCase(unittest.TestCase):
         self.assertEqual(a, {1: 2, 3: {4: 5}})
 
 
+class CaselessDictionaryTestCase(unittest.TestCase):
+
+    def test_keeps_first_key_case(self):
+        cd = CaselessDictionary({"FoO": 1})
+        cd["foo"] = 2
+        self.assertEqual(cd.keys(), ["FoO"])
+        self.assertEqual(cd.items(), [("FoO", 2)])
+
+    def test_get(self):
+        cd = CaselessDictionary({"FoO": 1})
+        self.assertEqual(cd.get("FOO"), 1)
+        self.assertEqual(cd.get("bar", 3), 3)
+
+    def test_views(self):
+        cd = CaselessDictionary({"FoO": 1, "bar": 2})
+        keys = cd.viewkeys()
+        cd["baz"] = 3
+        self.assertEqual(len(keys), 3)
+        self.assertTrue("BAZ" in keys)
+
+    def test_caseless_tree(self):
+        cd = caseless_tree({"a": {"B": {"c": ["1"]}}})
+        self.assertEqual(cd["A"]["b"]["C"], ["1"])
+
+
 class SetterDictTestCase(unittest.TestCase):
 
     def test_init_tiny(self):
@@ -97,6 +124,23 @@ class SetterDictTestCase(unittest.TestCase):
         sd.BAR = 4
         self.assertListEqual(sd.keys(), ["FoO", "baR"])
 
+    def test_to_dict_consume(self):
+        orig = {"a": {"b": ["3"], "c": {"d": ["4"]}, "e": ["1"]}}
+        sd = SetterDict(orig)
+        d = sd.to_dict(consume=True)
+        self.assertDictEqual(orig, d)
+        self.assertEqual(len(sd), 0)
+
+    def test_no_instance_dict(self):
+        sd = SetterDict()
+        sd.a.b = 1
+        self.assertFalse(hasattr(sd.a, "__dict__"))
+        self.assertTrue(isinstance(sd, CaselessDictionary))
+
+    def test_pickle(self):
+        sd = SetterDict({"A": {"b": 1}})
+        self.assertEqual(pickle.loads(pickle.dumps(sd)).a.B, 1)
+
 
 class AppendingDictTestCase(unittest.TestCase):
 
@@ -168,3 +212,16 @@ class AppendingDictTestCase(unittest.TestCase):
         ad = AppendingDict(orig)
         d = ad.to_dict()
         self.assertDictEqual(orig, d)
+
+    def test_extend_rows(self):
+        ad = AppendingDict()
+        ad.a.b = 0
+        ad.extend_rows([("A", "b", 1), ("a", "c", "d", 2), ("a", "C", "d", 3)])
+        self.assertDictEqual(
+            ad, {"a": {"b": ["0", "1"], "c": {"d": ["2", "3"]}}})
+        self.assertEqual(ad.keys(), ["a"])
+
+    def test_extend_rows_error_setting_subtree_with_scalar(self):
+        ad = AppendingDict()
+        ad.a.b.c = 1
+        self.assertRaises(ValueError, ad.extend_rows, [("a", "b", 2)])
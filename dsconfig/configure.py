@@ -1,15 +1,76 @@
 """Functionality for configuring a Tango DB from a dsconfig file"""
 
-from collections import defaultdict
+from collections import defaultdict, Mapping
 from functools import partial
+from hashlib import sha1
 
 import PyTango
-from appending_dict.caseless import CaselessDictionary
+from appending_dict.caseless import CaselessDictionary, caseless_tree
 
 from utils import ObjectWrapper
 from tangodb import SPECIAL_ATTRIBUTE_PROPERTIES, is_protected
 
 
+class TreeDigests(object):
+
+    """Computes content digests of the subtrees of nested dicts, in the
+    manner of a Merkle tree; the digest of a dict is made from the keys
+    and the digests of the values. Digests are remembered, so once they
+    are computed, comparing two subtrees costs O(1). If 'ignore_case' is
+    set, the case of keys is ignored.
+
+    Note: the dicts must not be modified while this is in use."""
+
+    def __init__(self, ignore_case=False):
+        self.ignore_case = ignore_case
+        self._digests = {}
+
+    def digest(self, node):
+        if not isinstance(node, Mapping):
+            return sha1(repr(node)).digest()
+        try:
+            return self._digests[id(node)][1]
+        except KeyError:
+            pass
+        items = []
+        for key, value in node.items():
+            if self.ignore_case:
+                key = key.lower()
+            items.append((key, self.digest(value)))
+        hasher = sha1()
+        for key, digest in sorted(items):
+            hasher.update(key)
+            hasher.update("\0")
+            hasher.update(digest)
+        result = hasher.digest()
+        # keep a reference to the node, so that its id isn't reused
+        self._digests[id(node)] = node, result
+        return result
+
+    def same(self, a, b):
+        "Check if two subtrees have the same contents"
+        return a is not None and b is not None and (
+            a is b or self.digest(a) == self.digest(b))
+
+
+def is_caseless_tree(data):
+    "Check that all levels of a nested dict are caseless"
+    return isinstance(data, CaselessDictionary) and all(
+        is_caseless_tree(value) for value in data.itervalues()
+        if isinstance(value, Mapping))
+
+
+def as_caseless(data):
+    """Returns a caseless version of the given nested dict, where all
+    levels are caseless (see caseless_tree). Does nothing if it's
+    already caseless all the way down, so that the DB data only needs
+    to be converted once and can then be shared by all the update_*
+    functions."""
+    if is_caseless_tree(data):
+        return data
+    return caseless_tree(data)
+
+
 def check_attribute_property(propname):
     # Is this too strict? Do we ever need non-standard attr props?
     if (not propname.startswith("_")
@@ -28,8 +89,8 @@ def update_properties(db, parent, db_props, new_props,
     'parent' is the name of the containing device or class.
     """
     if ignore_case:
-        caseless_db_props = CaselessDictionary(db_props)
-        caseless_new_props = CaselessDictionary(new_props)
+        caseless_db_props = as_caseless(db_props)
+        caseless_new_props = as_caseless(new_props)
     else:
         caseless_db_props = db_props
         caseless_new_props = new_props
@@ -40,20 +101,16 @@ def update_properties(db, parent, db_props, new_props,
         # the dict, since each attribute can have several properties.
         # A little messy, but at least it's consistent.
         for attr, props in new_props.items():
+            db_attr_props = caseless_db_props.get(attr, {})
             for prop, value in props.items():
-                if ignore_case:
-                    orig = CaselessDictionary(caseless_db_props.get(attr, {})).get(prop)
-                else:
-                    orig = caseless_db_props.get(attr, {}).get(prop)
+                orig = db_attr_props.get(prop)
                 if value and value != orig and check_attribute_property(prop):
                     added_props[attr][prop] = value
         removed_props = defaultdict(dict)
         for attr, props in db_props.items():
-            for prop in props:
-                if ignore_case:
-                    new = CaselessDictionary(new_props.get(attr, {})).get(prop)
-                else:
-                    new = new_props.get(attr, {}).get(prop)
+            new_attr_props = caseless_new_props.get(attr, {})
+            for prop, value in props.items():
+                new = new_attr_props.get(prop)
                 if (new is None and not is_protected(prop, True)) or new == []:
                     # empty list forces removal of "protected" properties
                     removed_props[attr][prop] = value
@@ -88,18 +145,21 @@ def update_properties(db, parent, db_props, new_props,
 
 def update_server(db, server_name, server_dict, db_dict,
                   update=False, ignore_case=False,
-                  difactory=PyTango.DbDevInfo):
+                  difactory=PyTango.DbDevInfo, digests=None):
 
     """Creates/removes devices for a given server. Optionally
-    ignores removed devices, only adding new and updating old ones."""
+    ignores removed devices, only adding new and updating old ones.
+    If 'digests' (a TreeDigests) is given, devices whose config is
+    identical to the DB are skipped."""
 
     if ignore_case:
-        db_dict = CaselessDictionary(db_dict)
+        db_dict = as_caseless(db_dict)
 
     for class_name, cls in server_dict.items():  # classes
         if ignore_case:
             cls = CaselessDictionary(cls)
-        removed_devices = [dev for dev in db_dict.get(class_name, {})
+        devs = db_dict.get(class_name, {})
+        removed_devices = [dev for dev in devs
                            if dev not in cls
                            # never remove dservers
                            and not class_name.lower() == "dserver"]
@@ -109,25 +169,25 @@ def update_server(db, server_name, server_dict, db_dict,
                 db.delete_device(device_name)
 
         for device_name, dev in added_devices:
-            if ignore_case:
-                devs = CaselessDictionary(db_dict.get(class_name, {}))
-            else:
-                devs = db_dict.get(class_name, {})
             if device_name not in devs:
                 devinfo = difactory()
                 devinfo.server = server_name
                 devinfo._class = class_name
                 devinfo.name = device_name
                 db.add_device(devinfo)
+            elif digests and digests.same(dev, devs[device_name]):
+                continue
 
             update_device(db, device_name, devs.get(device_name, {}),
-                          dev, update=update, ignore_case=ignore_case)
+                          dev, update=update, ignore_case=ignore_case,
+                          digests=digests)
 
     return added_devices, removed_devices
 
 
 def update_device_or_class(db, name, db_dict, new_dict,
-                           cls=False, update=False, ignore_case=False):
+                           cls=False, update=False, ignore_case=False,
+                           digests=None):
 
     "Configure a device or a class"
 
@@ -138,15 +198,17 @@ def update_device_or_class(db, name, db_dict, new_dict,
     if "properties" in new_dict:
         db_props = db_dict.get("properties", {})
         new_props = new_dict["properties"]
-        update_properties(db, name, db_props, new_props, cls=cls,
-                          delete=not update, ignore_case=ignore_case)
+        if not (digests and digests.same(new_props, db_props)):
+            update_properties(db, name, db_props, new_props, cls=cls,
+                              delete=not update, ignore_case=ignore_case)
 
     if "attribute_properties" in new_dict:
         db_attr_props = db_dict.get("attribute_properties", {})
         new_attr_props = new_dict["attribute_properties"]
-        update_properties(db, name, db_attr_props, new_attr_props,
-                          attribute=True, cls=cls, delete=not update,
-                          ignore_case=ignore_case)
+        if not (digests and digests.same(new_attr_props, db_attr_props)):
+            update_properties(db, name, db_attr_props, new_attr_props,
+                              attribute=True, cls=cls, delete=not update,
+                              ignore_case=ignore_case)
 
     # device aliases
     if not cls:
@@ -177,17 +239,35 @@ def configure(data, dbdata, update=False, ignore_case=False):
 
     db = ObjectWrapper()
 
+    # Most of the time, only a small part of the config differs from
+    # the DB, so we skip any identical subtrees early.
+    digests = TreeDigests(ignore_case)
+
+    # Caseless lookups in the DB data are done all over the place, so
+    # it's converted once, up front.
+    if ignore_case:
+        dbdata = as_caseless(dbdata)
+
     for servername, serverdata in data.get("servers", {}).items():
+        dbserverdata = dbdata.get("servers", {}).get(servername)
+        if digests.same(serverdata, dbserverdata):
+            continue
         for instname, instdata in serverdata.items():
             dbinstdata = (dbdata.get("servers", {})
                           .get(servername, {})
                           .get(instname, {}))
+            if digests.same(instdata, dbinstdata):
+                continue
             added, removed = update_server(
                 db, "%s/%s" % (servername, instname),
-                instdata, dbinstdata, update, ignore_case)
+                instdata, dbinstdata, update, ignore_case,
+                digests=digests)
 
     for classname, classdata in data.get("classes", {}).items():
         dbclassdata = dbdata.get("classes", {}).get(classname, {})
-        update_class(db, classname, dbclassdata, classdata, update=update)
+        if digests.same(classdata, dbclassdata):
+            continue
+        update_class(db, classname, dbclassdata, classdata, update=update,
+                     digests=digests)
 
     return db.calls
@@ -1,6 +1,5 @@
-from collections import Mapping
+from collections import defaultdict, Mapping
 import json
-import sys
 
 from utils import green, yellow, red
 
@@ -23,54 +22,85 @@ def dump_value(value):
         return "None"  # should never happen?
 
 
-def print_diff(dbdict, data, removes=True):
+def encode_pointer(parts):
+    "Make a JSON pointer string out of a sequence of keys"
+    return "".join("/" + p.replace("~", "~0").replace("/", "~1")
+                   for p in parts)
 
-    "Print a (hopefully) human readable list of changes."
+
+def iter_diff(old, new, ignore_case=True, path=()):
+
+    """Generate the operations needed to turn the 'old' config into the
+    'new' one, in the style of JSON patch, e.g.
+
+      {"op": "replace", "path": "/servers/TangoTest/...",
+       "value": ["2"], "old_value": ["1"]}
+
+    Only dicts are compared key by key (ignoring the case of the keys,
+    by default), while anything else, e.g. a property value, is compared
+    as a whole. Each level is gone through once, so the time taken is
+    proportional to the size of the configs."""
+
+    if ignore_case:
+        old_keys = dict((key.lower(), key) for key in old)
+    else:
+        old_keys = dict((key, key) for key in old)
+    for key, value in new.iteritems():
+        key_path = path + (key,)
+        old_key = old_keys.pop(key.lower() if ignore_case else key, None)
+        if old_key is None:
+            yield {"op": "add", "path": encode_pointer(key_path),
+                   "value": value}
+            continue
+        old_value = old[old_key]
+        if isinstance(value, Mapping) and isinstance(old_value, Mapping):
+            for op in iter_diff(old_value, value, ignore_case, key_path):
+                yield op
+        elif value != old_value:
+            yield {"op": "replace", "path": encode_pointer(key_path),
+                   "value": value, "old_value": old_value}
+    for old_key in old_keys.itervalues():
+        yield {"op": "remove", "path": encode_pointer(path + (old_key,)),
+               "old_value": old[old_key]}
+
+
+def print_diff(dbdict, data, removes=True, ignore_case=True):
+
+    """Print a (hopefully) human readable list of changes.
+
+    Returns the list of operations (see iter_diff). Note that they
+    differ from a JSON patch in that property values are replaced as a
+    whole, and that "replace" and "remove" also have the "old_value"."""
 
     # TODO: needs work, especially on multiline properties,
     # empty properties (should probably never be allowed but still)
     # and probably more corner cases. Also the output format could
     # use some tweaking.
 
-    try:
-        from collections import defaultdict
-        import jsonpatch
-        from jsonpointer import resolve_pointer, JsonPointerException
-
-        ops = defaultdict(int)
-
-        diff = jsonpatch.make_patch(dbdict, data)
-        for d in diff:
-            try:
-                ptr = " > ".join(decode_pointer(d["path"]))
-                if d["op"] == "replace":
-                    print yellow("REPLACE:")
-                    print yellow(ptr)
-                    db_value = resolve_pointer(dbdict, d["path"])
-                    print red(dump_value(db_value))
-                    print green(dump_value(d["value"]))
-                    ops["replace"] += 1
-                if d["op"] == "add":
-                    print green("ADD:")
-                    print green(ptr)
-                    if d["value"]:
-                        print green(dump_value(d["value"]))
-                    ops["add"] += 1
-                if removes and d["op"] == "remove":
-                    print red("REMOVE:")
-                    print red(ptr)
-                    value = resolve_pointer(dbdict, d["path"])
-                    if value:
-                        print red(dump_value(value))
-                    ops["remove"] += 1
-            except JsonPointerException as e:
-                print " - Error parsing diff - report this!: %s" % e
-        # # The following output is a bit misleading, removing for now
-        # print "Total: %d operations (%d replace, %d add, %d remove)" % (
-        #     sum(ops.values()), ops["replace"], ops["add"], ops["remove"])
-        return diff
-    except ImportError:
-        print >>sys.stderr, ("'jsonpatch' module not available - "
-                             "no diff printouts for you! (Try -d instead.)")
-
-
+    ops = defaultdict(int)
+    diff = []
+    for d in iter_diff(dbdict, data, ignore_case):
+        ptr = " > ".join(decode_pointer(d["path"]))
+        if d["op"] == "replace":
+            print yellow("REPLACE:")
+            print yellow(ptr)
+            print red(dump_value(d["old_value"]))
+            print green(dump_value(d["value"]))
+            ops["replace"] += 1
+        if d["op"] == "add":
+            print green("ADD:")
+            print green(ptr)
+            if d["value"]:
+                print green(dump_value(d["value"]))
+            ops["add"] += 1
+        if removes and d["op"] == "remove":
+            print red("REMOVE:")
+            print red(ptr)
+            if d["old_value"]:
+                print red(dump_value(d["old_value"]))
+            ops["remove"] += 1
+        diff.append(d)
+    # # The following output is a bit misleading, removing for now
+    # print "Total: %d operations (%d replace, %d add, %d remove)" % (
+    #     sum(ops.values()), ops["replace"], ops["add"], ops["remove"])
+    return diff
@@ -8,11 +8,20 @@ $ python -m dsconfig.dump device:sys/tg_test/1 device:sys/tg_test/2
 
 """
 
-from tangodb import get_servers_with_filters
-from appending_dict import SetterDict
+from tangodb import (any_condition, config_conditions, device_condition,
+                     filters_condition, get_class_properties,
+                     iter_servers_with_condition)
+from appending_dict import SetterDict, merge
+from filtering import filter_config
+from formatting import SERVERS_LEVELS
+from utils import get_devices_from_dict
 import PyTango
 
 
+# the "class" term can't be used as a keyword argument
+PATTERN_TERMS = {"class": "clss"}
+
+
 def get_db_data(db, patterns=None, **options):
 
     # dump TANGO database into JSON. Optionally filter which things to include
@@ -20,26 +29,111 @@ def get_db_data(db, patterns=None, **options):
     # servers/classes/devices to include, but you can't exclude selectively)
     # By default, dserver devices aren't included!
 
-    dbproxy = PyTango.DeviceProxy(db.dev_name())
-    data = SetterDict()
+    # All the patterns are combined into a single condition, so that
+    # the number of DB queries does not depend on the number of patterns.
+    # The servers tree is filled in one device at a time, so that when
+    # the "page_size" option is used, only one page of raw DB results
+    # needs to be held in memory at any time.
 
+    dservers = options.pop("dservers", False)
     if not patterns:
         # the user did not specify a pattern, so we will dump *everything*
-        servers = get_servers_with_filters(
-            dbproxy, **options)
-        data.servers.update(servers)
+        condition = device_condition(dservers=dservers)
     else:
-        # go through all patterns and fill in the data
+        conditions = []
         for pattern in patterns:
             prefix, pattern = pattern.split(":")
-            kwargs = {prefix: pattern}
-            kwargs.update(options)
-            servers = get_servers_with_filters(dbproxy, **kwargs)
-            data.servers.update(servers)
+            kwargs = {PATTERN_TERMS.get(prefix, prefix): pattern}
+            conditions.append(device_condition(dservers=dservers, **kwargs))
+        condition = any_condition(conditions)
+
+    dbproxy = PyTango.DeviceProxy(db.dev_name())
+    data = SetterDict()
+    for srv, inst, clss, device, config in iter_servers_with_condition(
+            dbproxy, condition, **options):
+        data.servers[srv][inst][clss][device] = config
 
     return data.to_dict()
 
 
+def get_db_data_for_config(db, config, include=None, exclude=None,
+                           **options):
+
+    # dump only the parts of the TANGO database that concern the given
+    # config; all devices in its server instances, any of its devices
+    # that are currently in some other server, and the class properties
+    # it mentions. This is all that's needed to compare it with the DB.
+    # Note that dserver devices *are* included.
+
+    # If the config has been filtered with include/exclude server
+    # filters, the properties of the other devices in its server
+    # instances are only fetched for the devices that may pass the
+    # filters (as far as that can be worked out in the DB query). The
+    # rest are still included, without properties, so that the servers
+    # are complete. Use filter_db_data to get the part that should be
+    # compared with the config; only that part is a faithful copy of
+    # the DB.
+
+    dbproxy = PyTango.DeviceProxy(db.dev_name())
+    data = SetterDict()
+
+    restrict = (filters_condition(include, exclude, SERVERS_LEVELS)
+                if include or exclude else None)
+    # (the config may name too many devices for a single query)
+    for condition in config_conditions(config, restrict=restrict):
+        for srv, inst, clss, device, dev in iter_servers_with_condition(
+                dbproxy, condition, **options):
+            data.servers[srv][inst][clss][device] = dev
+    if restrict:
+        device_options = dict(options, properties=False,
+                              attribute_properties=False)
+        for condition in config_conditions(config):
+            for srv, inst, clss, device, dev in iter_servers_with_condition(
+                    dbproxy, condition, **device_options):
+                devices = data.servers[srv][inst][clss]
+                if device not in devices:
+                    devices[device] = dev
+
+    classes = get_class_properties(dbproxy, config.get("classes", {}),
+                                   options.get("parallel", True))
+    if classes:
+        data.classes.update(classes)
+
+    return data.to_dict(consume=True)
+
+
+def filter_db_data(dbdata, config, include=None, exclude=None):
+
+    """Filter the servers in the DB data (see get_db_data_for_config)
+    with the same include/exclude filters as the config, so that only
+    the relevant devices are compared with it. The devices in the
+    config are always kept, as they may currently be in some other
+    server."""
+
+    if not (include or exclude):
+        return dbdata
+
+    config_devices = set(
+        device.lower() for _, _, _, device
+        in get_devices_from_dict(config.get("servers", {})))
+    kept = SetterDict()
+    others = SetterDict()
+    for srv, insts in dbdata.get("servers", {}).items():
+        for inst, classes in insts.items():
+            for clss, devices in classes.items():
+                for device, dev in devices.items():
+                    if device.lower() in config_devices:
+                        kept[srv][inst][clss][device] = dev
+                    else:
+                        others[srv][inst][clss][device] = dev
+    servers = kept.to_dict(consume=True)
+    merge(servers, filter_config(others.to_dict(consume=True), include,
+                                 SERVERS_LEVELS, excludes=exclude))
+    result = dict(dbdata)
+    result["servers"] = servers
+    return result
+
+
 def main():
 
     import json
@@ -62,6 +156,10 @@ def main():
     parser.add_option("-s", "--subdevices", dest="subdevices",
                       action="store_true", default=False,
                       help="Include __SubDevices property")
+    parser.add_option("-P", "--page-size", dest="page_size", type="int",
+                      default=0,
+                      help=("Fetch this many devices at a time from the DB "
+                            "(default: all at once)"))
 
     options, args = parser.parse_args()
 
@@ -70,7 +168,8 @@ def main():
                          properties=options.properties,
                          attribute_properties=options.attribute_properties,
                          aliases=options.aliases, dservers=options.dservers,
-                         subdevices=options.subdevices)
+                         subdevices=options.subdevices,
+                         page_size=options.page_size)
     print json.dumps(dbdata, ensure_ascii=False, indent=4, sort_keys=True)
 
 
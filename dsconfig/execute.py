@@ -0,0 +1,227 @@
+"""Functionality for performing a list of recorded Tango DB calls"""
+
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+import threading
+import time
+
+import PyTango
+
+from utils import progressbar
+
+
+# Calls that take a device or class name and a collection of properties,
+# so that several of them can be combined into one.
+MERGEABLE_METHODS = set([
+    "put_device_property",
+    "delete_device_property",
+    "put_device_attribute_property",
+    "delete_device_attribute_property",
+    "put_class_property",
+    "delete_class_property",
+    "put_class_attribute_property",
+    "delete_class_attribute_property"
+])
+
+
+def get_call_target(method, args):
+    "Return the name of the device/class/alias a DB call concerns"
+    if method == "add_device":
+        return args[0].name.lower()
+    return str(args[0]).lower()
+
+
+def merge_properties(method, old, new):
+    """Combine the property arguments of two calls of the same method.
+    The later one wins if they both contain the same property."""
+    if "attribute" in method:
+        merged = dict((attr, dict(props)) for attr, props in old.items())
+        for attr, props in new.items():
+            merged.setdefault(attr, {}).update(props)
+        return merged
+    if isinstance(old, dict):
+        merged = dict(old)
+        merged.update(new)
+        return merged
+    return list(old) + [prop for prop in new if prop not in old]
+
+
+def coalesce_calls(calls):
+
+    """Merge DB calls that can be performed as one, e.g. several
+    put_device_property calls for the same device. Calls are only merged
+    if there is no other call concerning the same device or class in
+    between, so the end result in the DB is the same. The given calls
+    are not modified."""
+
+    result = []
+    latest = {}  # target -> index in result of the latest call on it
+    for method, args, kwargs in calls:
+        target = get_call_target(method, args)
+        index = latest.get(target)
+        if (method in MERGEABLE_METHODS and not kwargs
+                and index is not None and result[index][0] == method
+                and not result[index][2]):
+            _, (name, props), _ = result[index]
+            result[index] = (method,
+                             (name, merge_properties(method, props, args[1])),
+                             {})
+        else:
+            latest[target] = len(result)
+            result.append((method, args, kwargs))
+    return result
+
+
+class Throttle(object):
+
+    """Adaptive rate limiting of DB calls. It keeps a running average
+    of the latency of the calls made, and adds a delay between calls
+    only when the DB gets noticeably slower than the best average seen
+    so far, i.e. when it seems to be under load. The delay grows with
+    the slowdown, up to a maximum."""
+
+    def __init__(self, smoothing=0.2, tolerance=2.0, max_delay=1.0):
+        self.smoothing = smoothing
+        self.tolerance = tolerance
+        self.max_delay = max_delay
+        self.average = None
+        self.baseline = None
+        # shared by the worker threads
+        self._lock = threading.Lock()
+
+    def record(self, latency):
+        "Register the time a call took"
+        with self._lock:
+            if self.average is None:
+                self.average = latency
+            else:
+                self.average += self.smoothing * (latency - self.average)
+            if self.baseline is None or self.average < self.baseline:
+                self.baseline = self.average
+
+    def get_delay(self):
+        "The time to wait before making the next call"
+        with self._lock:
+            if self.average is None:
+                return 0
+            excess = self.average - self.tolerance * self.baseline
+        return min(max(excess, 0), self.max_delay)
+
+
+def group_calls(calls):
+
+    """Split a list of DB calls into groups that each concern a single
+    device, class or alias, keeping the order within each group (e.g.
+    a device is added before its properties are set). Different groups
+    are independent of each other.
+
+    Since an alias may be moved from one device to another, calls on an
+    alias end up in the same group as the devices it is put on."""
+
+    # the group each target belongs to, when it's joined with another
+    joined = {}
+
+    def find(target):
+        while target in joined:
+            target = joined[target]
+        return target
+
+    for method, args, _ in calls:
+        if method == "put_device_alias":
+            device, alias = find(args[0].lower()), find(args[1].lower())
+            if device != alias:
+                joined[alias] = device
+
+    groups = OrderedDict()
+    for method, args, kwargs in calls:
+        target = find(get_call_target(method, args))
+        groups.setdefault(target, []).append((method, args, kwargs))
+    return groups.values()
+
+
+class CallExecutor(object):
+
+    """Performs groups of DB calls (see group_calls) using a number of
+    worker threads. Each worker gets its own DB connection from the
+    given factory, if any, otherwise the given DB object is used.
+    Failed calls are collected, and the rest of the group is then
+    skipped, while other groups go on."""
+
+    def __init__(self, db, sleep=None, workers=1, db_factory=None):
+        self.db = db
+        self.sleep = sleep
+        self.workers = workers
+        self.db_factory = db_factory
+        self.throttle = Throttle()
+        self._local = threading.local()
+
+    def _get_db(self):
+        if self.db_factory is None or self.workers <= 1:
+            return self.db
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = self.db_factory()
+        return db
+
+    def run_group(self, calls):
+        """Perform the calls in order. Returns the failed call along
+        with the error, if any, and the calls that were skipped."""
+        db = self._get_db()
+        for i, (method, args, kwargs) in enumerate(calls):
+            if self.sleep is None:
+                delay = self.throttle.get_delay()
+            else:
+                delay = self.sleep
+            if delay:
+                time.sleep(delay)
+            start = time.time()
+            try:
+                getattr(db, method)(*args, **kwargs)
+            except PyTango.DevFailed as e:
+                return calls, [(calls[i], e)], calls[i+1:]
+            finally:
+                self.throttle.record(time.time() - start)
+        return calls, [], []
+
+    def run(self, groups, verbose=False):
+        "Perform all the groups of calls. Returns failed and skipped calls"
+        n_calls = sum(len(group) for group in groups)
+        done = 0
+        failed = []
+        skipped = []
+        pool = ThreadPool(self.workers) if self.workers > 1 else None
+        results = (pool.imap_unordered(self.run_group, groups) if pool
+                   else (self.run_group(group) for group in groups))
+        try:
+            for calls, group_failed, group_skipped in results:
+                failed.extend(group_failed)
+                skipped.extend(group_skipped)
+                done += len(calls)
+                if verbose:
+                    progressbar(done - 1, n_calls, 20)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        return failed, skipped
+
+
+def execute_calls(db, calls, sleep=None, verbose=False, workers=1,
+                  db_factory=None):
+
+    """Perform the given DB calls, after coalescing them where possible.
+    By default the rate of calls is adapted to the latency of the DB,
+    but a fixed number of seconds to sleep between calls may be given
+    instead.
+
+    With several workers, calls concerning different devices or classes
+    are performed in parallel, each worker using a DB object from
+    'db_factory' (default is to share 'db').
+
+    A failing call does not stop the others, but the remaining calls
+    for the same device or class are skipped. Returns a list of the
+    failed calls, with the errors, and a list of the skipped calls."""
+
+    groups = group_calls(coalesce_calls(calls))
+    executor = CallExecutor(db, sleep, workers, db_factory)
+    return executor.run(groups, verbose)
@@ -1,66 +1,184 @@
 import re
+from collections import Mapping, OrderedDict
 
-from appending_dict import merge
 
+# characters that have a special meaning in a regex
+REGEX_SPECIAL = set(".^$*+?{}[]\\|()")
 
-def filter_nested_dict(node, pattern, depth, level=0, invert=False):
+
+class LiteralPattern(object):
+
+    """Stands in for a compiled regex that is just a string, e.g. a
+    device name, where a string comparison is a lot faster. It matches
+    the start of a key, ignoring case, or the whole key if 'exact'."""
+
+    def __init__(self, regex, literal, exact=False):
+        self.pattern = regex
+        self.literal = literal
+        self.lower = literal.lower()
+        self.exact = exact
+
+    def match(self, key):
+        if self.exact:
+            return key.lower() == self.lower
+        return key.lower().startswith(self.lower)
+
+
+def _compile_pattern(regex):
+    literal = regex[1:] if regex.startswith("^") else regex
+    exact = literal.endswith("$")
+    if exact:
+        literal = literal[:-1]
+    if literal and not set(literal) & REGEX_SPECIAL:
+        return LiteralPattern(regex, literal, exact)
+    return re.compile(regex, flags=re.IGNORECASE)
+
+
+# the most recently used patterns, compiled
+_patterns = OrderedDict()
+MAX_CACHED_PATTERNS = 1000
+
+
+def compile_pattern(regex):
+    """Compile a filter regex, ignoring case. Patterns that are plain
+    strings are not really compiled, but are matched more efficiently.
+    The last used patterns are cached."""
+    try:
+        pattern = _patterns.pop(regex)
+    except KeyError:
+        pattern = _compile_pattern(regex)
+        if len(_patterns) >= MAX_CACHED_PATTERNS:
+            _patterns.popitem(last=False)
+    _patterns[regex] = pattern
+    return pattern
+
+
+def parse_filter(fltr, levels):
     """
-    Filter the parts of a nested dict where keys match regex pattern,
-    at the given depth.
+    Compile a filter of the form '<term>:<regex>' into the depth where
+    it applies, and a list of (level, pattern) that must all match the
+    keys at those levels.
     """
-    if level == depth:
-        return dict((key, value) for key, value in node.iteritems()
-                    if (not invert and pattern.match(key)) or
-                    (invert and not pattern.match(key)))
+    try:
+        what, regex = fltr.split(":")
+        if what == "server" and "/" in regex:
+            # special case the "server/instance" syntax to match
+            # only the specific instance in the server
+            srv, inst = regex.split("/")
+            return 1, [(0, compile_pattern(srv)), (1, compile_pattern(inst))]
+        depth = levels[what]
+        return depth, [(depth, compile_pattern(regex))]
+    except (ValueError, IndexError):
+        raise ValueError(
+            "Bad filter '%s'; should be '<term>:<regex>'" % fltr)
+    except KeyError:
+        raise ValueError("Bad filter '%s'; term should be one of: %s"
+                         % (fltr, ", ".join(levels.keys())))
+    except re.error as e:
+        raise ValueError("Bad regular expression '%s': %s" % (fltr, e))
+
+
+class FilterSet(object):
+
+    """A number of filters, grouped by the depth where they apply, so
+    that they can all be checked in a single pass over the data."""
+
+    def __init__(self, filters, levels):
+        self.filters = {}
+        for fltr in filters:
+            depth, patterns = parse_filter(fltr, levels)
+            self.filters.setdefault(depth, []).append(patterns)
+        self.depth = max(self.filters) if self.filters else -1
+
+    def match(self, path):
+        "Check if any of the filters matches the given path of keys"
+        for patterns in self.filters.get(len(path) - 1, ()):
+            if all(pattern.match(path[level]) for level, pattern in patterns):
+                return True
+        return False
+
+    def get_exact_keys(self, path):
+        """If the only filters that may match below the given path all
+        require some exact key (ignoring case), return those keys so
+        they can be looked up directly. Otherwise None."""
+        if self.depth != len(path):
+            return None
+        keys = {}
+        for patterns in self.filters[self.depth]:
+            # the last pattern is for this level, the others are above
+            if all(pattern.match(path[level])
+                   for level, pattern in patterns[:-1]):
+                pattern = patterns[-1][1]
+                if not getattr(pattern, "exact", False):
+                    return None
+                keys[pattern.lower] = pattern.literal
+        return keys.values()
+
+
+def lookup_caseless(node, keys):
+    "Generate the items in a dict with the given keys, ignoring case"
+    missing = set()
+    for key in keys:
+        if key in node:
+            yield key, node[key]
+        else:
+            missing.add(key.lower())
+    if missing:
+        # the case is different, we need to look through the keys
+        for key, value in node.iteritems():
+            if key.lower() in missing:
+                yield key, value
+
+
+def filter_nested_dict(node, includes, excludes, path=(), included=False):
+    """
+    Filter the parts of a nested dict whose keys match the include
+    filters (everything below an included key is included), and not
+    the exclude filters. Subtrees that don't need further filtering are
+    kept as they are, and branches that end up empty are removed.
+    """
+    level = len(path)
+    result = {}
+    exact_keys = None if included else includes.get_exact_keys(path)
+    if exact_keys is None:
+        items = node.iteritems()
     else:
-        dupe_node = {}
-        for key, val in node.iteritems():
-            cur_node = filter_nested_dict(val, pattern, depth, level+1,
-                                          invert)
-            if cur_node:
-                dupe_node[key] = cur_node
-        return dupe_node or None
+        # no need to look at all the keys
+        items = lookup_caseless(node, exact_keys)
+    for key, value in items:
+        key_path = path + (key,)
+        if excludes.match(key_path):
+            continue
+        key_included = included or includes.match(key_path)
+        if key_included and level >= excludes.depth:
+            result[key] = value  # nothing more to filter below
+        elif isinstance(value, Mapping) and (key_included or
+                                             level < includes.depth):
+            filtered = filter_nested_dict(value, includes, excludes,
+                                          key_path, key_included)
+            if filtered:
+                result[key] = filtered
+        elif key_included:
+            result[key] = value
+    return result
 
 
-def filter_config(data, filters, levels, invert=False):
+def filter_config(data, filters, levels, invert=False, excludes=None):
 
     """Filter the given config data according to a list of filters.
     May be a positive filter (i.e. includes only matching things)
     or inverted (i.e. includes everything that does not match).
     The _levels_ argument is used to find at what depth in the data
     the filtering should happen.
+
+    Further filters to exclude may be given as _excludes_; all the
+    filters are then applied together, in one pass over the data.
     """
 
-    filtered = data if invert else {}
-    for fltr in filters:
-        try:
-            what, regex = fltr.split(":")
-            if what == "server" and "/" in regex:
-                # special case the "server/instance" syntax to return
-                # only the specific instance in the server
-                srv, inst = [re.compile(r, flags=re.IGNORECASE)
-                             for r in regex.split("/")]
-                servers = filter_nested_dict(data, srv, 0)
-                for k, v in servers.items():
-                    tmp = filter_nested_dict(v, inst, 0)
-                    if tmp:
-                        filtered[k] = tmp
-                continue
-            depth = levels[what]
-            pattern = re.compile(regex, flags=re.IGNORECASE)
-        except (ValueError, IndexError):
-            raise ValueError(
-                "Bad filter '%s'; should be '<term>:<regex>'" % fltr)
-        except KeyError:
-            raise ValueError("Bad filter '%s'; term should be one of: %s"
-                             % (fltr, ", ".join(levels.keys())))
-        except re.error as e:
-            raise ValueError("Bad regular expression '%s': %s" % (fltr, e))
-        if invert:
-            filtered = filter_nested_dict(filtered, pattern, depth,
-                                          invert=True)
-        else:
-            tmp = filter_nested_dict(data, pattern, depth)
-            if tmp:
-                merge(filtered, tmp)
-    return filtered
+    if invert:
+        filters, excludes = None, list(filters) + list(excludes or [])
+    includes = FilterSet(filters or [], levels)
+    excludes = FilterSet(excludes or [], levels)
+    # without include filters, everything is included
+    return filter_nested_dict(data, includes, excludes,
+                              included=filters is None)
@@ -2,13 +2,17 @@
 
 import sys
 import json
-from copy import deepcopy, copy
+from copy import copy
+from functools import partial
+from multiprocessing import Pool
 from os import path
 
-from appending_dict import AppendingDict, SetterDict
+from appending_dict import AppendingDict
 
 import PyTango
 
+from tangodb import get_devices_info
+
 
 SERVERS_LEVELS = {"server": 0, "instance": 1, "class": 2, "device": 3, "property": 5}
 CLASSES_LEVELS = {"class": 1, "property": 2}
@@ -47,40 +51,152 @@ def decode_dict(data):
     return rv
 
 
-def validate_json(data):
+def decode_values(data):
+    "Encode the unicode strings in a list, and in any lists inside it"
+    rv = []
+    for item in data:
+        if isinstance(item, unicode):
+            item = item.encode('utf-8')
+        elif isinstance(item, list):
+            item = decode_values(item)
+        rv.append(item)
+    return rv
+
+
+def decode_pairs(pairs):
+    """Turn the (key, value) pairs of a JSON object into a dict with
+    encoded strings. Meant as an 'object_pairs_hook' for the JSON
+    decoder, which means that any objects inside have already been
+    decoded, so unlike decode_dict it does not recurse into them."""
+    rv = {}
+    for key, value in pairs:
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        elif isinstance(value, list):
+            value = decode_values(value)
+        rv[key] = value
+    return rv
+
+
+# validators for the schema files loaded so far, by filename
+_validators = {}
+
+
+def get_validator(schema_filename=SCHEMA_FILENAME):
+    """Return a validator for the given schema file. The schema is only
+    loaded and checked once, and the validator is reused."""
+    validator = _validators.get(schema_filename)
+    if validator is None:
+        from jsonschema import Draft4Validator
+        with open(schema_filename) as schema_json:
+            schema = json.load(schema_json)
+        Draft4Validator.check_schema(schema)
+        validator = _validators[schema_filename] = Draft4Validator(schema)
+    return validator
+
+
+def format_validation_error(error):
+    "Describe a schema validation error, with the place it occurred"
+    location = " > ".join(str(part) for part in error.path)
+    return "%s: %s" % (location or "<top>", error.message)
+
+
+def get_shards(data, shard_size=100):
+    """Split a config into smaller configs that can be validated
+    separately; one with the toplevel, and the others each containing
+    a number of servers or classes."""
+    sections = [(key, data[key]) for key in ("servers", "classes")
+                if isinstance(data.get(key), dict)]
+    toplevel = dict(data)
+    for key, _ in sections:
+        toplevel[key] = {}
+    yield toplevel
+    for key, section in sections:
+        names = sorted(section)
+        for i in xrange(0, len(names), shard_size):
+            yield {key: dict((name, section[name])
+                             for name in names[i:i+shard_size])}
+
+
+def get_shard_errors(shard, schema_filename=SCHEMA_FILENAME):
+    "Return a list of the schema errors in a part of a config"
+    return [format_validation_error(error)
+            for error in get_validator(schema_filename).iter_errors(shard)]
+
+
+def get_validation_errors(data, schema_filename=SCHEMA_FILENAME,
+                          processes=1):
+    """Return a list of all the schema errors in the given config. The
+    config is validated in parts, using several processes if asked to."""
+    shards = get_shards(data)
+    if processes > 1:
+        pool = Pool(processes)
+        try:
+            results = pool.imap(
+                partial(get_shard_errors, schema_filename=schema_filename),
+                shards)
+            return [error for errors in results for error in errors]
+        finally:
+            pool.close()
+            pool.join()
+    return [error for shard in shards
+            for error in get_shard_errors(shard, schema_filename)]
+
+
+def validate_json(data, processes=1):
     """Validate that a given dict is of the right form"""
     try:
-        from jsonschema import validate, exceptions
-        with open(SCHEMA_FILENAME) as schema_json:
-            schema = json.load(schema_json)
-        validate(data, schema)
+        errors = get_validation_errors(data, processes=processes)
     except ImportError:
         print >>sys.stderr, ("WARNING: 'jsonschema' not installed, could not "
                              "validate json file. You're on your own.")
-    except exceptions.ValidationError as e:
-        print >>sys.stderr, "ERROR: JSON data does not match schema: %s" % e
+        return
+    if errors:
+        print >>sys.stderr, "ERROR: JSON data does not match schema:"
+        for error in errors:
+            print >>sys.stderr, "  %s" % error
         sys.exit(1)
 
 
 def load_json(f):
-    return json.load(f, object_hook=decode_dict)
+    return json.load(f, object_pairs_hook=decode_pairs)
 
 
-def expand_config(config):
+def expand_config(config, inplace=False):
 
     """Takes a configuration dict and expands it into the canonical
     format. This currently means that the server instance level is
-    split into a server and an instance level."""
+    split into a server and an instance level.
+
+    The given config is not changed, unless 'inplace' is set. Either way,
+    the result shares everything below the server level with it."""
 
-    expanded = deepcopy(config)
-    for servername in config["servers"]:
+    expanded = config if inplace else dict(config)
+    servers = config.get("servers")
+    if not servers or not any("/" in name for name in servers):
+        return expanded
+    new_servers = {}
+    names = {}  # lowercase server name -> name used in new_servers
+    owned = set()  # servers that were created here, and may be changed
+    for servername, data in servers.iteritems():
         if "/" in servername:
             server, instance = servername.split("/")
-            data = expanded["servers"].pop(servername)
-            if server in expanded["servers"]:
-                expanded["servers"][server].update({instance: data})
-            else:
-                expanded["servers"][server] = {instance: data}
+            data = {instance: data}
+        else:
+            server = servername
+        server = names.setdefault(server.lower(), server)
+        if server in new_servers:
+            if server not in owned:
+                new_servers[server] = dict(new_servers[server])
+            new_servers[server].update(data)
+            owned.add(server)
+        else:
+            new_servers[server] = data
+            if "/" in servername:
+                owned.add(server)
+    expanded["servers"] = new_servers
     return expanded
 
 
@@ -93,7 +209,7 @@ def clean_metadata(data):
     return tmp
 
 
-def normalize_config(config):
+def normalize_config(config, inplace=False):
 
     """Take a 'loose' config and return a new config that conforms to the
     DSConfig format.
@@ -109,21 +225,53 @@ def normalize_config(config):
       of having to list out the server, instance and class (since this
       information can be gotten from the DB.)
 
+    The result shares the device configs etc with the given config,
+    which is left unchanged, unless 'inplace' is set.
+
     """
-    old_config = expand_config(config)
-    new_config = SetterDict()
+    old_config = expand_config(config, inplace)
+    new_config = {}
     if "servers" in old_config:
-        new_config.servers = old_config["servers"]
+        new_config["servers"] = old_config["servers"]
     if "classes" in old_config:
-        new_config.classes = old_config["classes"]
+        new_config["classes"] = old_config["classes"]
     if "devices" in old_config:
+        servers = new_config.get("servers", {})
+        if not inplace:
+            servers = dict(servers)
+        new_config["servers"] = servers
+        keys = {}  # id of a dict -> its keys by lowercase
+        owned = set([id(servers)])  # ids of dicts we are allowed to change
+
+        def find_key(parent, key):
+            "The key already used in the dict for the given key, if any"
+            index = keys.get(id(parent))
+            if index is None:
+                index = keys[id(parent)] = dict((k.lower(), k)
+                                                for k in parent)
+            return index.setdefault(key.lower(), key)
+
+        def get_child(parent, key):
+            "The subtree under the given key (ignoring case)"
+            key = find_key(parent, key)
+            child = parent.get(key)
+            if child is None or not (inplace or id(child) in owned):
+                child = parent[key] = dict(child or {})
+                owned.add(id(child))
+            return child
+
         db = PyTango.Database()
+        dbproxy = PyTango.DeviceProxy(db.dev_name())
+        infos = get_devices_info(dbproxy, old_config["devices"])
         for device, props in old_config["devices"].items():
             try:
-                info = db.get_device_info(device)
-            except PyTango.DevFailed as e:
-                sys.exit("Can't reconfigure device %s: %s" % (device, str(e[0].desc)))
-            srv, inst = info.ds_full_name.split("/")
-            new_config.servers[srv][inst][info.class_name][device] = props
+                srv_inst, class_name = infos[device.lower()]
+            except KeyError:
+                sys.exit("Can't reconfigure device %s: not found in the DB"
+                         % device)
+            srv, inst = srv_inst.split("/")
+            devices = get_child(get_child(get_child(servers, srv), inst),
+                                class_name)
+            devices[find_key(devices, device)] = props
 
-    return new_config.to_dict()
+    return new_config
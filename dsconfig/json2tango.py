@@ -6,7 +6,6 @@ optionally be run.
 """
 
 import sys
-import time
 import json
 from optparse import OptionParser
 from tempfile import NamedTemporaryFile
@@ -18,9 +17,10 @@ from dsconfig.formatting import (CLASSES_LEVELS, SERVERS_LEVELS, load_json,
                                  normalize_config, validate_json,
                                  clean_metadata)
 from dsconfig.tangodb import summarise_calls, get_devices_from_dict
-from dsconfig.dump import get_db_data
-from dsconfig.utils import green, red, yellow, progressbar
-from dsconfig.output import show_actions
+from dsconfig.dump import filter_db_data, get_db_data_for_config
+from dsconfig.execute import execute_calls
+from dsconfig.utils import green, red, yellow
+from dsconfig.output import show_actions, write_changes
 from dsconfig.appending_dict.caseless import CaselessDictionary
 
 
@@ -42,6 +42,13 @@ def main():
     parser.add_option("-q", "--quiet",
                       action="store_false", dest="verbose", default=True,
                       help="don't print actions to stderr")
+    parser.add_option("--max-diff-lines", dest="max_diff_lines", type="int",
+                      help=("Max number of lines of changes to print per "
+                            "device"))
+    parser.add_option("--changes-json", dest="changes_json", metavar="FILE",
+                      help=("Write the changes as JSON Lines to the given "
+                            "file ('-' for stdout, which replaces the "
+                            "normal printout)"))
     parser.add_option("-o", "--output", dest="output", action="store_true",
                       help="Output the relevant DB state as JSON.")
     parser.add_option("-p", "--input", dest="input", action="store_true",
@@ -50,9 +57,17 @@ def main():
                       help="print out all db calls.")
     parser.add_option("-v", "--no-validation", dest="validate", default=True,
                       action="store_false", help=("Skip JSON validation"))
-    parser.add_option("-s", "--sleep", dest="sleep", default=0.01,
+    parser.add_option("--validation-processes", dest="validation_processes",
+                      default=1, type="int",
+                      help=("Number of processes to use for validating "
+                            "large JSON files"))
+    parser.add_option("-s", "--sleep", dest="sleep", default=None,
                       type="float",
-                      help=("Number of seconds to sleep between DB calls"))
+                      help=("Number of seconds to sleep between DB calls "
+                            "(default: adapt to the load on the DB)"))
+    parser.add_option("-j", "--jobs", dest="jobs", default=1, type="int",
+                      help=("Number of DB calls to perform in parallel, "
+                            "for different devices"))
 
     parser.add_option("-i", "--include", dest="include", action="append",
                       help=("Inclusive filter on server configutation"))
@@ -80,30 +95,25 @@ def main():
             data = load_json(f)
 
     # Normalization - making the config conform to standard
-    data = normalize_config(data)
+    data = normalize_config(data, inplace=True)
 
     # remove any metadata at the top level (should we use this for something?)
     data = clean_metadata(data)
 
     # Optional validation of the JSON file format.
     if options.validate:
-        validate_json(data)
+        validate_json(data, processes=options.validation_processes)
 
     # filtering
     try:
-        if options.include:
+        if options.include or options.exclude:
             data["servers"] = filter_config(
-                data.get("servers", {}), options.include, SERVERS_LEVELS)
-        if options.exclude:
-            data["servers"] = filter_config(
-                data.get("servers", {}), options.exclude, SERVERS_LEVELS, invert=True)
-        if options.include_classes:
-            data["classes"] = filter_config(
-                data.get("classes", {}), options.include_classes, CLASSES_LEVELS)
-        if options.exclude_classes:
+                data.get("servers", {}), options.include, SERVERS_LEVELS,
+                excludes=options.exclude)
+        if options.include_classes or options.exclude_classes:
             data["classes"] = filter_config(
-                data.get("classes", {}), options.exclude_classes, CLASSES_LEVELS,
-                invert=True)
+                data.get("classes", {}), options.include_classes,
+                CLASSES_LEVELS, excludes=options.exclude_classes)
     except ValueError as e:
         sys.exit("Filter error:\n%s" % e)
 
@@ -121,16 +131,17 @@ def main():
             original = json.loads(f.read())
         collisions = {}
     else:
-        original = get_db_data(db, dservers=True)
+        original = get_db_data_for_config(db, data, include=options.include,
+                                          exclude=options.exclude)
         devices = CaselessDictionary({
             dev: (srv, inst, cls)
             for srv, inst, cls, dev
-            in get_devices_from_dict(data["servers"])
+            in get_devices_from_dict(data.get("servers", {}))
         })
         orig_devices = CaselessDictionary({
             dev: (srv, inst, cls)
             for srv, inst, cls, dev
-            in get_devices_from_dict(original["servers"])
+            in get_devices_from_dict(original.get("servers", {}))
         })
         collisions = {}
         for dev, (srv, inst, cls) in devices.items():
@@ -141,28 +152,40 @@ def main():
                 if server.lower() != origserver.lower():
                     collisions.setdefault(origserver, []).append((ocls, dev))
 
-    # get the list of DB calls needed
-    dbcalls = configure(data, original,
+    # get the list of DB calls needed; only the DB data that passes the
+    # filters is compared with the (filtered) config, and it's also what
+    # gets shown and saved. The complete data may lack the properties of
+    # devices that the filters leave out, and is only used for finding
+    # collisions and for the summary.
+    dbdata = filter_db_data(original, data, options.include, options.exclude)
+    dbcalls = configure(data, dbdata,
                         update=options.update,
                         ignore_case=not options.case_sensitive)
 
     # Print out a nice diff
-    if options.verbose:
-        show_actions(original, dbcalls)
+    if options.changes_json == "-":
+        write_changes(dbdata, dbcalls, sys.stdout)
+    elif options.verbose:
+        show_actions(dbdata, dbcalls, max_lines=options.max_diff_lines)
+    if options.changes_json and options.changes_json != "-":
+        with open(options.changes_json, "w") as f:
+            write_changes(dbdata, dbcalls, f)
     
     # perform the db operations (if we're supposed to)
+    failed, skipped = [], []
     if options.write and dbcalls:
-        for i, (method, args, kwargs) in enumerate(dbcalls):
-            if options.sleep:
-                time.sleep(options.sleep)
-            if options.verbose:
-                progressbar(i, len(dbcalls), 20)
-            getattr(db, method)(*args, **kwargs)
-        print
+        failed, skipped = execute_calls(db, dbcalls, sleep=options.sleep,
+                                        verbose=options.verbose,
+                                        workers=options.jobs,
+                                        db_factory=PyTango.Database)
+        print >>sys.stderr
+        for (method, args, kwargs), error in failed:
+            print >>sys.stderr, red("FAILED:"), method, args
+            print >>sys.stderr, "    ", str(error[0].desc)
 
     # optionally dump some information to stdout
     if options.output:
-        print json.dumps(original, indent=4)
+        print json.dumps(dbdata, indent=4)
     if options.dbcalls:
         print >>sys.stderr, "Tango database calls:"
         for method, args, kwargs in dbcalls:
@@ -184,7 +207,7 @@ def main():
 
     # finally print out a brief summary of what was done
     if dbcalls:
-        print
+        print >>sys.stderr
         print >>sys.stderr, "Summary:"
         print >>sys.stderr, "\n".join(summarise_calls(dbcalls, original))
         if collisions:
@@ -199,9 +222,12 @@ def main():
             print >>sys.stderr, red("\n*** Data was written to the Tango DB ***")
             with NamedTemporaryFile(prefix="dsconfig-", suffix=".json",
                                     delete=False) as f:
-                f.write(json.dumps(original, indent=4))
+                f.write(json.dumps(dbdata, indent=4))
                 print >>sys.stderr, ("The previous DB data was saved to %s" %
                                      f.name)
+            if failed:
+                sys.exit(red("*** %d DB calls failed, %d were skipped ***" %
+                             (len(failed), len(skipped))))
         else:
             print >>sys.stderr, yellow(
                 "\n*** Nothing was written to the Tango DB (use -w) ***")
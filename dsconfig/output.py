@@ -1,21 +1,50 @@
 from difflib import ndiff
-
-from PyTango.utils import CaselessDict
-
-from dsconfig.utils import green, red, yellow
-from dsconfig.tangodb import get_devices_from_dict
-from appending_dict import SetterDict
-
-
-def get_device_data(device, mapping, data):
-    if device in mapping:
-        server, instance, clss = mapping[device]
-        return CaselessDict(data["servers"][server][instance][clss]).get(device, {})
-    return {}
-
-
-def property_diff(old, new, indentation=""):
-    diff = ndiff(old, new)
+import json
+import sys
+
+from dsconfig.utils import green, red, yellow, ENDC
+from appending_dict import CaselessDictionary, SetterDict
+from appending_dict.caseless import caseless_tree
+
+
+def index_devices(servers):
+    """Make a caseless index of the devices in a "servers" dict, giving
+    the server, instance, class and config of each device."""
+    index = CaselessDictionary()
+    for server, instances in servers.items():
+        for instance, classes in instances.items():
+            for clss, devices in classes.items():
+                for device, config in devices.items():
+                    index[device] = (server, instance, clss, config)
+    return index
+
+
+# Above this number of differing lines, ndiff (which is roughly
+# quadratic) is not used to line up the old and new property values
+MAX_NDIFF_LINES = 200
+
+
+def property_diff(old, new, indentation="", max_ndiff_lines=MAX_NDIFF_LINES):
+    """Make a diff of two property values. Lines that are the same at
+    the start and end are not compared further, and if there are still
+    many lines left, they are simply shown as removed and added, so
+    that long properties don't take forever."""
+    start = 0
+    while start < min(len(old), len(new)) and old[start] == new[start]:
+        start += 1
+    end = 0
+    while (end < min(len(old), len(new)) - start
+           and old[-end - 1] == new[-end - 1]):
+        end += 1
+    old_changed = old[start:len(old) - end]
+    new_changed = new[start:len(new) - end]
+    if len(old_changed) + len(new_changed) <= max_ndiff_lines:
+        diff = list(ndiff(old_changed, new_changed))
+    else:
+        diff = (["- " + line for line in old_changed] +
+                ["+ " + line for line in new_changed])
+    diff = (["  " + line for line in old[:start]] + diff +
+            ["  " + line for line in old[len(old) - end:]])
     lines = []
     for line in diff:
         if line.startswith("+"):
@@ -36,23 +65,166 @@ def format_property(value, indentation="", max_lines=10):
                      for line in value[:max_lines]) + ending
 
 
-def get_changes(data, calls):
+# The DB calls that change things in devices or classes
+DEVICE_METHODS = set([
+    "put_device_alias", "add_device", "delete_device",
+    "put_device_property", "delete_device_property",
+    "put_device_attribute_property", "delete_device_attribute_property"
+])
+CLASS_METHODS = set([
+    "put_class_property", "delete_class_property",
+    "put_class_attribute_property", "delete_class_attribute_property"
+])
+
+
+def record_change(change, method, args, old, location=None):
+
+    """Add the change made by a database call to the changes of the
+    device or class concerned. 'old' is its current config (caseless),
+    and 'location' is the (server, instance, class, config) of the
+    device, if it exists."""
+
+    if method == "put_device_alias":
+        _, alias = args
+        old_alias = old.get("alias")
+        change.update({
+            "alias": {"old_value": old_alias,
+                      "value": alias}
+        })
+
+    elif method == "add_device":
+        info, = args
+        change.update(added=True, server=info.server,
+                      device_class=info._class)
+        if location:
+            old_server, old_instance, old_class, _ = location
+            change["old_server"] = "{}/{}".format(old_server, old_instance)
+            change["old_class"] = old_class
+
+    elif method == "delete_device":
+        server, instance, clss, device_data = location
+        properties = device_data.get("properties", {})
+        change.update(
+            deleted=True,
+            server="{}/{}".format(server, instance),
+            instance=instance,
+            device_class=clss,
+            properties=properties)
+
+    elif method == "put_device_property":
+        _, properties = args
+        old_props = old.get("properties", {})
+        prop_changes = change.setdefault("properties", {})
+        for name, value in properties.items():
+            old_value = old_props.get(name)
+            if value != old_value:
+                prop_changes[name] = {"value": value,
+                                      "old_value": old_value}
+
+    elif method == "delete_device_property":
+        _, properties = args
+        old_props = old.get("properties", {})
+        prop_changes = change.setdefault("properties", {})
+        for prop in properties:
+            prop_changes[prop] = {"old_value": old_props[prop]}
+
+    elif method == "put_device_attribute_property":
+        _, properties = args
+        attr_props = change.setdefault("attribute_properties", {})
+        old_attrs = old.get("attribute_properties", {})
+        for attr, props in properties.items():
+            old_props = old_attrs.get(attr, {})
+            for name, value in props.items():
+                old_value = old_props.get(name)
+                if value != old_value:
+                    attr_props.setdefault(attr, {})[name] = {
+                        "old_value": old_value, "value": value}
+
+    elif method == "delete_device_attribute_property":
+        _, attributes = args
+        attr_props = change.setdefault("attribute_properties", {})
+        old_attrs = old.get("attribute_properties", {})
+        for attr, props in attributes.items():
+            old_props = old_attrs[attr]
+            for prop in props:
+                attr_props.setdefault(attr, {})[prop] = {
+                    "old_value": old_props.get(prop)}
+
+    elif method == "put_class_property":
+        _, properties = args
+        old_props = old.get("properties", {})
+        prop_changes = change.setdefault("properties", {})
+        for name, value in properties.items():
+            old_value = old_props.get(name)
+            if value != old_value:
+                prop_changes[name] = {"value": value,
+                                      "old_value": old_value}
+
+    elif method == "delete_class_property":
+        _, properties = args
+        old_props = old.get("properties", {})
+        prop_changes = change.setdefault("properties", {})
+        for prop in properties:
+            prop_changes[prop] = {"old_value": old_props.get(prop)}
+
+    elif method == "put_class_attribute_property":
+        _, properties = args
+        attr_props = change.setdefault("attribute_properties", {})
+        old_attrs = old.get("attribute_properties", {})
+        for attr, props in properties.items():
+            old_props = old_attrs.get(attr, {})
+            for name, value in props.items():
+                old_value = old_props.get(name)
+                if value != old_value:
+                    attr_props.setdefault(attr, {})[name] = {
+                        "old_value": old_value, "value": value}
+
+    elif method == "delete_class_attribute_property":
+        _, attributes = args
+        attr_props = change.setdefault("attribute_properties", {})
+        old_attrs = old.get("attribute_properties", {})
+        for attr, props in attributes.items():
+            old_props = old_attrs.get(attr, {})
+            for prop in props:
+                attr_props.setdefault(attr, {})[prop] = {
+                    "old_value": old_props.get(prop)}
+
+
+def get_calls_by_target(calls):
+    """Collect the calls per device and per class, in name order. The
+    name first used for each is kept."""
+    groups = {"devices": {}, "classes": {}}
+    for call in calls:
+        method, args, _ = call
+        if method in DEVICE_METHODS:
+            kind = "devices"
+            name = args[0].name if method == "add_device" else args[0]
+        elif method in CLASS_METHODS:
+            kind, name = "classes", args[0]
+        else:
+            continue
+        groups[kind].setdefault(name.lower(), (name, []))[1].append(call)
+    return dict((kind, sorted(group.values(), key=lambda item: item[0]))
+                for kind, group in groups.items())
 
-    """Combine a list of database calls into "changes" that can
-    be more easily turned into a readable representation"""
 
-    devices = get_devices_from_dict(data["servers"])
-    device_mapping = CaselessDict(
-        (device, (server, instance, clss))
-        for server, instance, clss, device in devices
-    )
-    classes = data.get("classes", {})
+def iter_changes(data, calls, kind="devices"):
+
+    """Generate (name, changes) for each device (or class, if 'kind'
+    is "classes") concerned by the calls, in name order. The changes of
+    each one are only worked out when it's its turn, so that they can
+    be used (e.g. printed) right away, and dropped afterwards."""
+
+    if kind == "devices":
+        device_index = index_devices(data.get("servers", {}))
+    else:
+        classes = CaselessDictionary(data.get("classes", {}))
 
-    # The idea is to first go through all database calls and collect
-    # the changes per device. Then we can print it all out in a more
+    # The idea is to first group the database calls, and collect the
+    # changes per device. Then we can print it all out in a more
     # readable format since it will all be collected per device.
     #
-    # Example of resulting dict:
+    # Example of resulting changes (as collected by get_changes):
     # {
     #     "sys/tg_test/1": {
     #         "server": "TangoTest",
@@ -76,265 +248,164 @@ def get_changes(data, calls):
     #     }
     # }
 
-    changes = {
-        "devices": SetterDict(),
-        "classes": SetterDict()
-    }
+    for name, group in get_calls_by_target(calls)[kind]:
+        if kind == "devices":
+            location = device_index.get(name)
+            old = caseless_tree(location[3] if location else {})
+        else:
+            location = None
+            old = caseless_tree(classes.get(name, {}))
+        change = SetterDict()
+        for method, args, _ in group:
+            record_change(change, method, args, old, location)
+        yield name, change.to_dict(consume=True)
 
-    # Go through all database calls and store the changes
-    for method, args, kwargs in calls:
 
-        if method == "put_device_alias":
-            device, alias = args
-            if device in device_mapping:
-                old_alias = get_device_data(
-                    device, device_mapping, data).get("alias")
-            else:
-                old_alias = None
-            changes["devices"][device].update({
-                "alias": {"old_value": old_alias,
-                          "value": alias}
-            })
-
-        elif method == "add_device":
-            info, = args
-            changes["devices"][info.name].update(added=True,
-                                                 server=info.server,
-                                                 device_class=info._class)
-            if info.name in device_mapping:
-                old_server, old_instance, old_class = device_mapping[info.name]
-                changes["devices"][info.name]["old_server"] = "{}/{}".format(
-                    old_server, old_instance)
-                changes["devices"][info.name]["old_class"] = old_class
-
-        elif method == "delete_device":
-            device, = args
-            server, instance, clss = device_mapping[device]
-            device_data = data["servers"][server][instance][clss]
-            properties = device_data.get("properties", {})
-            changes["devices"][device].update(
-                deleted=True,
-                server="{}/{}".format(server, instance),
-                instance=instance,
-                device_class=clss,
-                properties=properties)
-
-        elif method == "put_device_property":
-            device, properties = args
-            old_data = get_device_data(device, device_mapping, data)
-            caseless_props = CaselessDict(old_data.get("properties", {}))
-            if "properties" not in changes["devices"][device]:
-                changes["devices"][device]["properties"] = {}
-            for name, value in properties.items():
-                old_value = caseless_props.get(name)
-                if value != old_value:
-                    changes["devices"][device]["properties"].update({
-                        name: {
-                            "value": value,
-                            "old_value": old_value
-                        }
-                    })
-
-        elif method == "delete_device_property":
-            device, properties = args
-            old_data = get_device_data(device, device_mapping, data)
-            caseless_props = CaselessDict(old_data.get("properties", {}))
-            prop_changes = changes["devices"][device].setdefault(
-                "properties", {})
-            for prop in properties:
-                old_value = caseless_props[prop]
-                prop_changes[prop] = {"old_value": old_value}
-
-        elif method == "put_device_attribute_property":
-            device, properties = args
-            attr_props = changes["devices"][device].setdefault(
-                "attribute_properties", {})
-            old_data = get_device_data(device, device_mapping, data)
-            caseless_attrs = CaselessDict(old_data.get(
-                "attribute_properties", {}))
-            for attr, props in properties.items():
-                caseless_props = CaselessDict(caseless_attrs.get(attr, {}))
-                for name, value in props.items():
-                    old_value = caseless_props.get(name)
-                    if value != old_value:
-                        attr_props[attr] = {
-                            name: {"old_value": old_value,
-                                   "value": value}
-                        }
-
-        elif method == "delete_device_attribute_property":
-            device, attributes = args
-            prop_changes = attr_props = changes["devices"][device].setdefault(
-                "attribute_properties", {})
-            old_data = get_device_data(device, device_mapping, data)
-            caseless_attrs = CaselessDict(old_data.get("attribute_properties", {}))
-            for attr, props in attributes.items():
-                caseless_props = CaselessDict(caseless_attrs[attr])
-                for prop in props:
-                    old_value = caseless_props.get(prop)
-                    attr_props[attr] = {prop: {"old_value": old_value}}
-
-        elif method == "put_class_property":
-            clss, properties = args
-            old_data = classes.get(clss, {})
-            caseless_props = CaselessDict(old_data.get("properties", {}))
-            prop_changes = changes["classes"][clss].setdefault("properties", {})
-            for name, value in properties.items():
-                old_value = caseless_props.get(name)
-                if value != old_value:
-                    prop_changes.update({
-                        name: {
-                            "value": value,
-                            "old_value": old_value}
-                    })
-
-        elif method == "delete_class_property":
-            clss, properties = args
-            old_data = classes.get(clss, {})
-            caseless_props = CaselessDict(old_data.get("properties", {}))
-            prop_changes = changes["classes"][clss].setdefault("properties", {})
-            for prop in properties:
-                old_value = caseless_props.get(prop)
-                prop_changes[prop] = {"old_value": old_value}
-
-        elif method == "put_class_attribute_property":
-            clss, properties = args
-            attr_props = changes["classes"][clss].setdefault(
-                "attribute_properties", {})
-            old_data = classes.get(clss, {})
-            caseless_attrs = CaselessDict(
-                old_data.get("attribute_properties", {}))
-            for attr, props in properties.items():
-                caseless_props = CaselessDict(caseless_attrs.get(attr, {}))
-                for name, value in props.items():
-                    old_value = caseless_props.get(name)
-                    if value != old_value:
-                        attr_props[attr] = {
-                            name: {"old_value": old_value,
-                                   "value": value}
-                        }
-
-        elif method == "delete_class_attribute_property":
-            clss, attributes = args
-            attr_props = changes["classes"][clss].setdefault(
-                "attribute_properties", {})
-            old_data = classes.get(clss, {})
-            caseless_attrs = CaselessDict(old_data.get("properties", {}))
-            for attr, props in attributes.items():
-                caseless_props = CaselessDict(caseless_attrs.get(attr, {}))
-                for prop in props:
-                    old_value = caseless_props.get(prop)
-                    attr_props[attr] = {prop: {"old_value": old_value}}
+def get_changes(data, calls):
+
+    """Combine a list of database calls into "changes" that can
+    be more easily turned into a readable representation"""
 
     return {
-        "devices": changes["devices"].to_dict(),
-        "classes": changes["classes"].to_dict(),
+        "devices": dict(iter_changes(data, calls, "devices")),
+        "classes": dict(iter_changes(data, calls, "classes")),
     }
 
 
-def show_actions(data, calls):
+def write_changes(data, calls, out):
 
-    "Print out a human readable representation of changes"
+    """Write the changes as JSON Lines, i.e. one JSON object per line,
+    for each device and then each class. E.g.
 
-    changes = get_changes(data, calls)
+      {"device": "sys/tg_test/1", "changes": {"properties": {...}}}
 
-    # Go through all the devices that have been touched
-    # and print out a representation of the changes.
-    # TODO: is there a more reasonable way to sort this?
-    indent = " " * 2
-    for device in sorted(changes["devices"]):
-        info = changes["devices"][device]
-        if info.get("added"):
-            if info.get("old_server"):
-                print("{} Device: {}".format(yellow("="), device))
-            else:
-                print("{} Device: {}".format(green("+"), device))
-        elif info.get("deleted"):
-            print("{} Device: {}".format(red("-"), device))
+    The changes are in the same format as from get_changes. Each line
+    is written as soon as it's ready."""
+
+    for kind, key in (("devices", "device"), ("classes", "class")):
+        for name, changes in iter_changes(data, calls, kind):
+            out.write(json.dumps({key: name, "changes": changes}))
+            out.write("\n")
+
+
+def format_device_changes(device, info, indent="  "):
+
+    "Make a human readable representation of the changes to a device"
+
+    lines = []
+    if info.get("added"):
+        if info.get("old_server"):
+            lines.append("{} Device: {}".format(yellow("="), device))
         else:
-            print("{} Device: {}".format(yellow("="), device))
+            lines.append("{} Device: {}".format(green("+"), device))
+    elif info.get("deleted"):
+        lines.append("{} Device: {}".format(red("-"), device))
+    else:
+        lines.append("{} Device: {}".format(yellow("="), device))
 
-        if info.get("server"):
-            if info.get("old_server"):
-                print("{}Server: {} -> {}".format(indent,
-                                                  red(info["old_server"]),
-                                                  green(info["server"])))
-            else:
-                print("{}Server: {}".format(indent, info["server"]))
-
-        if info.get("device_class"):
-            if info.get("old_class"):
-                if info["old_class"] != info["device_class"]:
-                    print("{}Class: {} -> {}".format(indent,
-                                                     info["old_class"],
-                                                     info["device_class"]))
-            else:
-                print("{}Class: {}".format(indent, info["device_class"]))
-
-        if info.get("alias"):
-            alias = info.get("alias").get("value")
-            old_alias = info.get("alias").get("old_value")
-            if old_alias:
-                if old_alias != alias:
-                    print("{}Alias: {} -> {}".format(indent, red(old_alias),
-                                                     green(alias)))
+    if info.get("server"):
+        if info.get("old_server"):
+            lines.append("{}Server: {} -> {}".format(indent,
+                                                     red(info["old_server"]),
+                                                     green(info["server"])))
+        else:
+            lines.append("{}Server: {}".format(indent, info["server"]))
+
+    if info.get("device_class"):
+        if info.get("old_class"):
+            if info["old_class"] != info["device_class"]:
+                lines.append("{}Class: {} -> {}".format(indent,
+                                                        info["old_class"],
+                                                        info["device_class"]))
+        else:
+            lines.append("{}Class: {}".format(indent, info["device_class"]))
+
+    if info.get("alias"):
+        alias = info.get("alias").get("value")
+        old_alias = info.get("alias").get("old_value")
+        if old_alias:
+            if old_alias != alias:
+                lines.append("{}Alias: {} -> {}".format(indent, red(old_alias),
+                                                        green(alias)))
+        else:
+            lines.append("{}Alias: {}".format(indent, alias))
+
+    if info.get("properties"):
+        prop_lines = []
+        for prop, change in sorted(info.get("properties", {}).items()):
+            if change.get("value"):
+                value = change.get("value")
+                old_value = change.get("old_value")
+                if old_value is not None:
+                    if old_value != value:
+                        # change property
+                        prop_lines.append(yellow("{}= {}".format(indent*2, prop)))
+                        prop_lines.append(property_diff(
+                            change["old_value"], change["value"], indent*3))
+                else:
+                    # new property
+                    prop_lines.append(green("{}+ {}".format(indent*2, prop)))
+                    prop_lines.append(green(format_property(change["value"],
+                                                            indent*3)))
             else:
-                print("{}Alias: {}".format(indent, alias))
-
-        if info.get("properties"):
-            lines = []
-            for prop, change in sorted(info.get("properties", {}).items()):
-                if change.get("value"):
-                    value = change.get("value")
-                    old_value = change.get("old_value")
+                # delete property
+                prop_lines.append(red("{}- {}".format(indent*2, prop)))
+                prop_lines.append(red(format_property(change["old_value"],
+                                                      indent*3)))
+        if prop_lines:
+            lines.append("{}Properties:".format(indent*1))
+            lines.extend(prop_lines)
+
+    if info.get("attribute_properties"):
+        prop_lines = []
+        for attr, props in sorted(
+                info.get("attribute_properties", {}).items()):
+            attr_lines = []
+            for prop, change in sorted(props.items()):
+                value = change.get("value")
+                old_value = change.get("old_value")
+                if value is not None:
                     if old_value is not None:
-                        if old_value != value:
-                            # change property
-                            lines.append(yellow("{}= {}".format(indent*2, prop)))
-                            lines.append(property_diff(
-                                change["old_value"], change["value"], indent*3))
+                        # change
+                        if value != old_value:
+                            attr_lines.append(yellow("{}= {}".format(indent*3, prop)))
+                            attr_lines.append(property_diff(
+                                change["old_value"], change["value"], indent*4))
                     else:
-                        # new property
-                        lines.append(green("{}+ {}".format(indent*2, prop)))
-                        lines.append(green(format_property(change["value"],
-                                                           indent*3)))
+                        # addition
+                        attr_lines.append(green("{}+ {}".format(indent*3, prop)))
+                        attr_lines.append(green(format_property(change["value"],
+                                                                indent*4)))
                 else:
-                    # delete property
-                    lines.append(red("{}- {}".format(indent*2, prop)))
-                    lines.append(red(format_property(change["old_value"], indent*3)))
-            if lines:
-                print("{}Properties:".format(indent*1))
-                print("\n".join(lines))
-
-        if info.get("attribute_properties"):
-            lines = []
-            for attr, props in sorted(
-                    info.get("attribute_properties", {}).items()):
-                attr_lines = []
-                for prop, change in sorted(props.items()):
-                    value = change.get("value")
-                    old_value = change.get("old_value")
-                    if value is not None:
-                        if old_value is not None:
-                            # change
-                            if value != old_value:
-                                attr_lines.append(yellow("{}= {}".format(indent*3, prop)))
-                                attr_lines.append(property_diff(
-                                    change["old_value"], change["value"], indent*4))
-                        else:
-                            # addition
-                            attr_lines.append(green("{}+ {}".format(indent*3, prop)))
-                            attr_lines.append(green(format_property(change["value"],
-                                                                    indent*4)))
-                    else:
-                        # removal
-                        attr_lines.append(red("{}- {}".format(indent*3, prop)))
-                        attr_lines.append(red(format_property(change["old_value"],
-                                                              indent*4)))
-                if attr_lines:
-                    lines.append("{}{}".format(indent*2, attr))
-                    lines.extend(attr_lines)
-            if lines:
-                print("{}Attribute properties:".format(indent))
-                print("\n".join(lines))
-        print
+                    # removal
+                    attr_lines.append(red("{}- {}".format(indent*3, prop)))
+                    attr_lines.append(red(format_property(change["old_value"],
+                                                          indent*4)))
+            if attr_lines:
+                prop_lines.append("{}{}".format(indent*2, attr))
+                prop_lines.extend(attr_lines)
+        if prop_lines:
+            lines.append("{}Attribute properties:".format(indent))
+            lines.extend(prop_lines)
+
+    return lines
+
+
+def show_actions(data, calls, out=None, max_lines=None):
+
+    """Print out a human readable representation of changes. Each device
+    is printed as soon as its changes are worked out, with a single
+    write. With 'max_lines', the output for each device is cut off
+    after that many lines."""
+
+    out = out or sys.stdout
+    # TODO: is there a more reasonable way to sort this?
+    for device, info in iter_changes(data, calls):
+        lines = "\n".join(format_device_changes(device, info)).split("\n")
+        if max_lines and len(lines) > max_lines:
+            hidden = len(lines) - max_lines
+            # (the last line may be in the middle of a colored part)
+            lines = lines[:max_lines]
+            lines.append("{}  ... [{} more lines]".format(ENDC, hidden))
+        lines.append("\n")
+        out.write("\n".join(lines))
@@ -3,21 +3,25 @@ import sys
 
 import PyTango
 
-from utils import (ObjectWrapper, decode_dict, get_dict_from_db,
-                   RED, GREEN, YELLOW)
+from appending_dict import SetterDict
+from formatting import decode_dict
+from tangodb import get_dict_from_db
+from utils import ObjectWrapper, RED, GREEN, YELLOW
 
 
-def delete_devices(db, dbdict, server, cls, devices):
+def delete_devices(db, dbdict, server, inst, cls, devices):
+    db_devices = dbdict.servers[server][inst][cls]
     for devname in devices:
-        if dbdict.servers[server][cls][devname]:
+        if devname in db_devices:
             db.delete_device(devname)
         else:
             print "no device", devname
 
 
-def delete_server(db, dbdict, servername, serverdata):
-    for clsname, devices in serverdata.items():
-        delete_devices(db, dbdict, servername, clsname, devices.keys())
+def delete_server(db, dbdict, server, inst, instdata):
+    servername = "%s/%s" % (server, inst)
+    for clsname, devices in instdata.items():
+        delete_devices(db, dbdict, server, inst, clsname, devices.keys())
     try:
         db.delete_server_info(servername)  # what does this do?
         db.delete_server(servername)
@@ -47,15 +51,18 @@ def main(json_file, write=False, db_calls=False):
         data = json.load(f, object_hook=decode_dict)
 
     db = PyTango.Database()
-    dbdict = get_dict_from_db(db, data)  # check the current DB state
+    # check the current DB state, using a few big queries
+    dbdict, _ = get_dict_from_db(db, data, narrow=True, bulk=True)
+    dbdict = SetterDict(dbdict)
 
     # wrap the database (and fake it if we're not going to write)
     db = ObjectWrapper(db if write else None)
 
     # delete servers and devices
-    for servername, serverdata in data.get("servers", {}).items():
-        if servername in dbdict.servers:
-            delete_server(db, dbdict, servername, serverdata)
+    for server, insts in data.get("servers", {}).items():
+        for inst, instdata in insts.items():
+            if inst in dbdict.servers.get(server, {}):
+                delete_server(db, dbdict, server, inst, instdata)
 
     # delete classes
     for classname, classdata in data.get("classes", {}).items():
@@ -3,10 +3,14 @@
 from collections import defaultdict
 from difflib import unified_diff
 from itertools import izip, islice
+from multiprocessing.pool import ThreadPool
+import string
+import threading
 
 import PyTango
 
 from appending_dict import AppendingDict, SetterDict, CaselessDictionary
+from dsconfig.filtering import parse_filter
 from dsconfig.utils import green, red, yellow
 
 
@@ -213,15 +217,60 @@ def get_device(db, devname, data, skip_protected=True):
     return dev
 
 
-def get_dict_from_db(db, data, narrow=False, skip_protected=True):
+def filter_device(dbdev, data, skip_protected=True):
+
+    """Takes the full DB information about a device (as returned by
+    e.g. get_servers_with_filters) and keeps the same parts of it
+    that get_device would."""
+
+    dev = {}
+
+    if "alias" in dbdev:
+        dev["alias"] = dbdev["alias"]
+
+    if "properties" in dbdev:
+        dev["properties"] = dict(
+            (prop, value) for prop, value in dbdev["properties"].items()
+            if (not (skip_protected and is_protected(prop))
+                or prop in data.get("properties", {})))
+
+    attr_props = CaselessDictionary(data.get("attribute_properties", {}))
+    if attr_props:
+        attribute_properties = {}
+        for attr, props in dbdev.get("attribute_properties", {}).items():
+            if attr not in attr_props:
+                continue
+            new_props = CaselessDictionary(attr_props[attr])
+            props = dict(
+                (prop, value) for prop, value in props.items()
+                if (not (skip_protected and is_protected(prop, True))
+                    or prop in new_props))
+            if props:
+                attribute_properties[attr] = props
+        if attribute_properties:
+            dev["attribute_properties"] = attribute_properties
+
+    return dev
+
+
+def get_dict_from_db(db, data, narrow=False, skip_protected=True,
+                     bulk=False):
 
     """Takes a data dict, checks if any if the definitions are already
     in the DB and returns a dict describing them.
 
     By default it includes all devices for each server+class, use the
     'narrow' flag to limit to the devices present in the input data.
+
+    The 'bulk' flag makes it get everything using a fixed number of
+    SQL queries, instead of several DB calls per device. This is much
+    faster for large configurations.
     """
 
+    if bulk:
+        dbproxy = PyTango.DeviceProxy(db.dev_name())
+        return get_dict_from_db_bulk(dbproxy, data, narrow, skip_protected)
+
     # This is where we'll collect all the relevant data
     dbdict = SetterDict()
     moved_devices = defaultdict(list)
@@ -332,91 +381,491 @@ def maybe_upper(s, upper=False):
     return s
 
 
+def sql_list(values):
+    "Format a sequence of strings as a SQL list, e.g. for an IN clause"
+    return ", ".join("'%s'" % v.replace("'", "''") for v in values)
+
+
+def device_condition(server="*", clss="*", device="*", dservers=False):
+    """
+    Build a SQL condition on the 'device' table that selects devices
+    by server, class and device name. The arguments may contain
+    wildcards (*).
+    """
+    condition = ("device.server LIKE '%s' AND device.class LIKE '%s'"
+                 " AND device.name LIKE '%s'"
+                 % (server.replace("*", "%"),  # mysql wildcards
+                    clss.replace("*", "%"),
+                    device.replace("*", "%")))
+    if not dservers:
+        condition += " AND device.class != 'DServer'"
+    return condition
+
+
+def any_condition(conditions):
+    "Combine SQL conditions so that any of them may match"
+    return " OR ".join("(%s)" % condition for condition in conditions)
+
+
+# SQL expressions for the keys at each level of the "servers" config
+SERVERS_LEVEL_COLUMNS = {
+    0: "SUBSTRING_INDEX(device.server, '/', 1)",
+    1: "SUBSTRING_INDEX(device.server, '/', -1)",
+    2: "device.class",
+    3: "device.name"
+}
+
+# A regex that only uses these characters (and no non-greedy repetition,
+# extension syntax, empty groups or POSIX classes like "[[:alpha:]]")
+# means the same thing to MySQL as to python. Bounds ({}) and alternatives
+# (|) are left out, since e.g. "a{,3}" and "a|" are fine in python but not
+# in (older) MySQL.
+SQL_REGEX_CHARS = set(string.ascii_letters + string.digits +
+                      " _-/.:@*+?()[]^$,")
+SQL_REGEX_SPECIAL = set(".*+?()[]^$")
+
+
+def regex_condition(column, regex):
+    """
+    Translate a regex, as used with re.match (i.e. matching from the
+    start, ignoring case), into a SQL condition on the given column.
+    Returns None unless the condition matches exactly the same things.
+    """
+    if (not regex or not set(regex) <= SQL_REGEX_CHARS
+            or any(s in regex for s in ("(?", "*?", "+?", "??", "()",
+                                        "[:", "[.", "[="))):
+        return None
+    if not set(regex) & SQL_REGEX_SPECIAL:
+        # just a string; this should be faster than a regex
+        return "%s LIKE '%s%%'" % (column, regex.replace("_", "\\_"))
+    return "%s REGEXP '^(%s)'" % (column, regex.replace("'", "''"))
+
+
+def filter_condition(fltr, levels, columns=SERVERS_LEVEL_COLUMNS):
+    """Translate a config filter (see filtering.py) into a SQL condition
+    on the device table, or None if that is not possible."""
+    _, patterns = parse_filter(fltr, levels)
+    conditions = []
+    for level, pattern in patterns:
+        condition = None
+        if level in columns:
+            condition = regex_condition(columns[level], pattern.pattern)
+        if condition is None:
+            return None
+        conditions.append(condition)
+    return " AND ".join(conditions)
+
+
+def filters_condition(includes, excludes, levels):
+    """
+    Build a SQL condition on the device table from include and exclude
+    filters, selecting the devices that may be kept by the filters. The
+    filters that can't be translated exactly are left out, so the
+    condition may select more devices than the filters do, but never
+    fewer; in particular, an exclude filter is only used if it means the
+    same in SQL. Returns None if nothing could be translated.
+    """
+    conditions = []
+    if includes:
+        include_conditions = [filter_condition(fltr, levels)
+                              for fltr in includes]
+        if None not in include_conditions:
+            conditions.append(any_condition(include_conditions))
+    for fltr in excludes or []:
+        condition = filter_condition(fltr, levels)
+        if condition is not None:
+            conditions.append("NOT (%s)" % condition)
+    return " AND ".join("(%s)" % c for c in conditions) or None
+
+
+def query_device_properties(dbproxy, condition, subdevices=False):
+    "Get (device, property, value) rows for the devices matching condition"
+    query = (
+        "SELECT device, property_device.name, property_device.value"
+        " FROM property_device"
+        " INNER JOIN device ON property_device.device = device.name"
+        " WHERE (%s)" % condition)
+    if not subdevices:
+        query += " AND property_device.name != '__SubDevices'"
+    _, result = dbproxy.command_inout("DbMySqlSelect", query)
+    return nwise(result, 3)
+
+
+def query_device_attribute_properties(dbproxy, condition):
+    """Get (device, attribute, property, value) rows for the devices
+    matching condition"""
+    query = (
+        "SELECT device, attribute, property_attribute_device.name,"
+        " property_attribute_device.value"
+        " FROM property_attribute_device"
+        " INNER JOIN device ON property_attribute_device.device ="
+        " device.name"
+        " WHERE (%s)" % condition)
+    _, result = dbproxy.command_inout("DbMySqlSelect", query)
+    return nwise(result, 4)
+
+
+def query_class_properties(dbproxy, condition):
+    "Get (class, property, value) rows for the classes matching condition"
+    query = ("SELECT class, name, value FROM property_class"
+             " WHERE (%s)" % condition)
+    _, result = dbproxy.command_inout("DbMySqlSelect", query)
+    return nwise(result, 3)
+
+
+def query_class_attribute_properties(dbproxy, condition):
+    """Get (class, attribute, property, value) rows for the classes
+    matching condition"""
+    query = ("SELECT class, attribute, name, value"
+             " FROM property_attribute_class WHERE (%s)" % condition)
+    _, result = dbproxy.command_inout("DbMySqlSelect", query)
+    return nwise(result, 4)
+
+
+def query_devices(dbproxy, condition, limit=None, offset=0):
+    """Get (server, class, device, alias) rows for the devices matching
+    condition. If a limit is given, only that many rows are returned,
+    starting from offset, in device name order."""
+    query = ("SELECT server, class, name, alias FROM device"
+             " WHERE (%s)" % condition)
+    if limit:
+        query += " ORDER BY name LIMIT %d OFFSET %d" % (limit, offset)
+    _, result = dbproxy.command_inout("DbMySqlSelect", query)
+    return nwise(result, 4)
+
+
+def decode_value(value):
+    "The properties are encoded in latin-1 in the DB; we want utf-8"
+    return value.decode('iso-8859-1').encode('utf8')
+
+
+def build_device_configs(property_rows, attribute_property_rows,
+                         uppercase_devices=False):
+    """Combine device property and attribute property rows into a dict
+    of device configs, keyed on device name."""
+
+    devices = AppendingDict()
+    devices.extend_rows(
+        (maybe_upper(d, uppercase_devices), "properties", p, decode_value(v))
+        for d, p, v in property_rows)
+    devices.extend_rows(
+        (maybe_upper(d, uppercase_devices), "attribute_properties", a, p,
+         decode_value(v))
+        for d, a, p, v in attribute_property_rows)
+
+    return devices.to_dict(consume=True)
+
+
+class QueryRunner(object):
+
+    """Runs DB queries, either one after another on the given proxy,
+    or in parallel. In the latter case each worker thread gets its own
+    proxy to the DB device, since they are not shared safely between
+    threads."""
+
+    def __init__(self, dbproxy, parallel=True, workers=3):
+        self.dbproxy = dbproxy
+        self.pool = ThreadPool(workers) if parallel else None
+        self._local = threading.local()
+
+    def _get_proxy(self):
+        proxy = getattr(self._local, "proxy", None)
+        if proxy is None:
+            proxy = PyTango.DeviceProxy(self.dbproxy.dev_name())
+            proxy.set_timeout_millis(self.dbproxy.get_timeout_millis())
+            self._local.proxy = proxy
+        return proxy
+
+    def _run_query(self, query):
+        func, args = query[0], query[1:]
+        return list(func(self._get_proxy(), *args))
+
+    def run(self, *queries):
+        """Run the queries, each given as a tuple (function, args...),
+        and return the resulting rows in the same order. A query
+        given as None results in no rows."""
+        if self.pool is None:
+            return [list(q[0](self.dbproxy, *q[1:])) if q else []
+                    for q in queries]
+        results = [self.pool.apply_async(self._run_query, (q,)) if q else None
+                   for q in queries]
+        return [r.get() if r else [] for r in results]
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+
+def get_device_pages(dbproxy, condition, page_size):
+    """
+    Generate the device rows matching condition, one page at a time.
+    Each page comes with a condition that selects exactly the devices
+    in it, so that their properties can be fetched page by page too.
+    """
+    offset = 0
+    while True:
+        rows = list(query_devices(dbproxy, condition, page_size, offset))
+        if not rows:
+            return
+        names = [d for _, _, d, _ in rows]
+        yield rows, "device.name IN (%s)" % sql_list(names)
+        if len(rows) < page_size:
+            return
+        offset += page_size
+
+
+# Server and class of the devices looked up so far, by lowercase name
+_device_info_cache = {}
+
+
+def get_devices_info(dbproxy, devices, chunk_size=1000):
+    """
+    Look up the server (e.g. 'TangoTest/1') and class of a number of
+    devices, using one query per chunk of devices. Returns a dict of
+    (server, class) keyed on lowercase device name. Devices that are
+    not in the DB are left out. The results are kept for the rest of
+    the process, so each device is only looked up once.
+    """
+    names = set(device.lower() for device in devices)
+    missing = [name for name in names if name not in _device_info_cache]
+    for i in xrange(0, len(missing), chunk_size):
+        condition = "device.name IN (%s)" % sql_list(
+            missing[i:i+chunk_size])
+        for server, clss, name, _ in query_devices(dbproxy, condition):
+            _device_info_cache[name.lower()] = (server, clss)
+    return dict((name, _device_info_cache[name])
+                for name in names if name in _device_info_cache)
+
+
+def iter_servers_with_condition(dbproxy, condition, properties=True,
+                                attribute_properties=True, aliases=True,
+                                subdevices=False, uppercase_devices=False,
+                                timeout=10, page_size=None, parallel=True):
+    """
+    Generate (server, instance, class, device, config) for each device
+    matching the given SQL condition on the device table.
+
+    If page_size is given, the devices are fetched that many at a
+    time (along with their properties), so that the amount of data
+    held in memory is bounded regardless of the size of the DB.
+
+    With the parallel flag, independent queries are run at the same
+    time, each on its own connection.
+    """
+
+    # Queries can sometimes take more than de default 3 s, so it's
+    # good to increase the timeout a bit.
+    # TODO: maybe instead use automatic retry and increase timeout
+    # each time?
+    dbproxy.set_timeout_millis(timeout*1000)
+
+    def config_queries(condition):
+        return [
+            ((query_device_properties, condition, subdevices)
+             if properties else None),
+            ((query_device_attribute_properties, condition)
+             if attribute_properties else None)
+        ]
+
+    def combine(rows, property_rows, attribute_property_rows):
+        devices = build_device_configs(property_rows,
+                                       attribute_property_rows,
+                                       uppercase_devices)
+        for s, c, d, a in rows:
+            try:
+                srv, inst = s.split("/")
+            except ValueError:
+                # Malformed server name? It can happen!
+                continue
+            devname = maybe_upper(d, uppercase_devices)
+            config = devices.get(devname, {})
+            if a and aliases:
+                config["alias"] = a
+            yield srv, inst, c, devname, config
+
+    runner = QueryRunner(dbproxy, parallel)
+    try:
+        if page_size:
+            for rows, page_condition in get_device_pages(dbproxy, condition,
+                                                         page_size):
+                results = runner.run(*config_queries(page_condition))
+                for item in combine(rows, *results):
+                    yield item
+        else:
+            # everything at once; all the queries are independent
+            results = runner.run((query_devices, condition),
+                                 *config_queries(condition))
+            for item in combine(*results):
+                yield item
+    finally:
+        runner.close()
+
+
+def iter_servers_with_filters(dbproxy, server="*", clss="*", device="*",
+                              dservers=False, **options):
+    """
+    Generate (server, instance, class, device, config) for each device
+    matching the filters. See get_servers_with_filters.
+    """
+    condition = device_condition(server, clss, device, dservers)
+    return iter_servers_with_condition(dbproxy, condition, **options)
+
+
 def get_servers_with_filters(dbproxy, server="*", clss="*", device="*",
                              properties=True, attribute_properties=True,
                              aliases=True, dservers=False,
                              subdevices=False, uppercase_devices=False,
-                             timeout=10):
+                             timeout=10, page_size=None, parallel=True):
     """
     A performant way to get servers and devices in bulk from the DB
     by direct SQL statements and joins, instead of e.g. using one
     query to get the properties of each device.
 
-    TODO: are there any length restrictions on the query results? In
-    that case, use limit and offset to get page by page.
+    Use page_size to limit the number of devices fetched per query,
+    on large databases. The parallel flag runs independent queries at
+    the same time, on separate connections.
     """
 
-    server = server.replace("*", "%")  # mysql wildcards
-    clss = clss.replace("*", "%")
-    device = device.replace("*", "%")
+    condition = device_condition(server, clss, device, dservers)
+    servers = SetterDict()
+    for srv, inst, c, devname, config in iter_servers_with_condition(
+            dbproxy, condition, properties, attribute_properties, aliases,
+            subdevices, uppercase_devices, timeout, page_size, parallel):
+        servers[srv][inst][c][devname] = config
+    return servers
 
-    devices = AppendingDict()
 
-    # Queries can sometimes take more than de default 3 s, so it's
-    # good to increase the timeout a bit.
-    # TODO: maybe instead use automatic retry and increase timeout
-    # each time?
-    dbproxy.set_timeout_millis(timeout*1000)
+def config_conditions(data, narrow=False, restrict=None, chunk_size=1000):
 
-    if properties:
-        # Get all relevant device properties
-        query = (
-            "SELECT device, property_device.name, property_device.value"
-            " FROM property_device"
-            " INNER JOIN device ON property_device.device = device.name"
-            " WHERE server LIKE '%s' AND class LIKE '%s' AND device LIKE '%s'")
-        if not dservers:
-            query += " AND class != 'DServer'"
-        if not subdevices:
-            query += " AND property_device.name != '__SubDevices'"
-        _, result = dbproxy.command_inout("DbMySqlSelect",
-                                          query % (server, clss, device))
-        for d, p, v in nwise(result, 3):
-            # the properties are encoded in latin-1; we want utf-8
-            decoded_value = v.decode('iso-8859-1').encode('utf8')
-            devices[maybe_upper(d, uppercase_devices)].properties[p] = decoded_value
-
-    if attribute_properties:
-        # Get all relevant attribute properties
-        query = (
-            "SELECT device, attribute, property_attribute_device.name,"
-            " property_attribute_device.value"
-            " FROM property_attribute_device"
-            " INNER JOIN device ON property_attribute_device.device ="
-            " device.name"
-            " WHERE server LIKE '%s' AND class LIKE '%s' AND device LIKE '%s'")
-        if not dservers:
-            query += " AND class != 'DServer'"
-        _, result = dbproxy.command_inout("DbMySqlSelect", query % (server, clss, device))
-        for d, a, p, v in nwise(result, 4):
-            dev = devices[maybe_upper(d, uppercase_devices)]
-            # the properties are encoded in latin-1; we want utf-8
-            decoded_value = v.decode('iso-8859-1').encode('utf8')
-            dev.attribute_properties[a][p] = decoded_value
-
-    devices = devices.to_dict()
-
-    # dump relevant servers
-    query = (
-        "SELECT server, class, name, alias FROM device"
-        " WHERE server LIKE '%s' AND class LIKE '%s' AND name LIKE '%s'")
+    """Build SQL conditions selecting the devices in the DB that concern
+    the given config: all devices in its server instances and any
+    devices in it that are currently defined elsewhere. The 'narrow'
+    flag limits it to the devices present in the config, while a
+    'restrict' condition only limits the other devices in the server
+    instances.
 
-    if not dservers:
-        query += " AND class != 'DServer'"
-    _, result = dbproxy.command_inout("DbMySqlSelect", query % (server, clss, device))
+    To keep the queries to a reasonable size, each condition names at
+    most 'chunk_size' devices and servers, so a large config gives
+    several conditions. A device may be selected by more than one of
+    them. Returns an empty list if no devices are concerned."""
 
-    # combine all the information we have
-    servers = SetterDict()
-    for s, c, d, a in nwise(result, 4):
-        try:
-            srv, inst = s.split("/")
-        except ValueError:
-            # Malformed server name? It can happen!
-            continue
-        devname = maybe_upper(d, uppercase_devices)
-        device = devices.get(devname, {})
-        if a and aliases:
-            device["alias"] = a
-        servers[srv][inst][c][devname] = device
+    server_names = set()
+    device_names = set()
+    for srvr, insts in data.get("servers", {}).items():
+        for inst, classes in insts.items():
+            server_names.add("%s/%s" % (srvr, inst))
+            for devs in classes.values():
+                device_names.update(devs)
+    if narrow:
+        server_names = set()
+
+    device_names = sorted(device_names)
+    server_names = sorted(server_names)
+    conditions = []
+    for i in xrange(0, max(len(device_names), len(server_names)),
+                    chunk_size):
+        condition = []
+        devices = device_names[i:i+chunk_size]
+        if devices:
+            condition.append("device.name IN (%s)" % sql_list(devices))
+        servers = server_names[i:i+chunk_size]
+        if servers:
+            server_condition = "device.server IN (%s)" % sql_list(servers)
+            if restrict:
+                server_condition += " AND (%s)" % restrict
+            condition.append(server_condition)
+        conditions.append(any_condition(condition))
+    return conditions
+
+
+def get_class_properties(dbproxy, classes, parallel=True):
+
+    """Get the properties and attribute properties of the given classes
+    from the DB. Only the properties and attributes that are present in
+    the 'classes' dict are included."""
+
+    if not classes:
+        return {}
+
+    # lowercase names of the relevant properties and attributes
+    wanted = dict(
+        (class_name.lower(),
+         (class_name,
+          set(prop.lower() for prop in cls.get("properties", {})),
+          set(attr.lower() for attr in cls.get("attribute_properties", {}))))
+        for class_name, cls in classes.items())
+
+    condition = "class IN (%s)" % sql_list(classes.keys())
+    runner = QueryRunner(dbproxy, parallel)
+    try:
+        property_rows, attribute_property_rows = runner.run(
+            (query_class_properties, condition),
+            (query_class_attribute_properties, condition))
+    finally:
+        runner.close()
 
-    return servers
+    class_props = AppendingDict()
+    class_props.extend_rows(
+        (wanted[c.lower()][0], "properties", p, decode_value(v))
+        for c, p, v in property_rows
+        if p.lower() in wanted[c.lower()][1])
+    class_props.extend_rows(
+        (wanted[c.lower()][0], "attribute_properties", a, p, decode_value(v))
+        for c, a, p, v in attribute_property_rows
+        if a.lower() in wanted[c.lower()][2])
+
+    return class_props.to_dict(consume=True)
+
+
+def get_dict_from_db_bulk(dbproxy, data, narrow=False, skip_protected=True,
+                          parallel=True):
+
+    """Does the same as get_dict_from_db, but using a fixed number of
+    SQL queries, regardless of the number of devices and classes."""
+
+    dbdict = SetterDict()
+    moved_devices = defaultdict(list)
+
+    # Collect what we need to look for in the DB
+    classes = {}
+    new_devices = CaselessDictionary()
+    for srvr, insts in data.get("servers", {}).items():
+        for inst, clsses in insts.items():
+            for clss, devs in clsses.items():
+                srv_full_name = "%s/%s" % (srvr, inst)
+                classes[srv_full_name.lower(), clss.lower()] = (
+                    srvr, inst, clss, CaselessDictionary(devs))
+                for device in devs:
+                    new_devices[device] = (srv_full_name, clss)
+
+    # Servers
+    seen = set()
+    for condition in config_conditions(data, narrow):
+        for srv, inst, clss, device, dbdev in iter_servers_with_condition(
+                dbproxy, condition, subdevices=True, parallel=parallel):
+            if device.lower() in seen:
+                continue  # already selected by another condition
+            seen.add(device.lower())
+            srv_full_name = "%s/%s" % (srv, inst)
+            # devices that are already defined somewhere else
+            if device in new_devices:
+                new_srv_full_name, new_clss = new_devices[device]
+                if srv_full_name.lower() != new_srv_full_name.lower():
+                    moved_devices[srv_full_name].append((new_clss, device))
+            key = srv_full_name.lower(), clss.lower()
+            if key not in classes:
+                continue
+            srvr, inst, clss, devs = classes[key]
+            if narrow and device not in devs:
+                continue
+            dbdict.servers[srvr][inst][clss][device] = filter_device(
+                dbdev, devs.get(device, {}), skip_protected)
+
+    # Classes
+    class_props = get_class_properties(dbproxy, data.get("classes", {}),
+                                       parallel)
+    if class_props:
+        dbdict.classes.update(class_props)
+
+    return dbdict.to_dict(), moved_devices
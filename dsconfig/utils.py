@@ -29,10 +29,10 @@ def progressbar(i, n, width):
         progress = float(i) / (n - 1)
     hashes = '#' * int(round(progress * width))
     spaces = ' ' * (width - len(hashes))
-    sys.stdout.write(
+    sys.stderr.write(
         "\rProgress: [{0}] {1}%".format(hashes + spaces,
                                         int(round(progress * 100))))
-    sys.stdout.flush()
+    sys.stderr.flush()
 
 
 def find_device(definitions, devname, caseless=False):
@@ -1,27 +1,23 @@
-import json
 import sys
 
-from jsonschema import Draft4Validator, validate, exceptions
-
-from utils import decode_dict
+from formatting import load_json, get_validation_errors
 
 
 if __name__ == "__main__":
     data_filename, schema_filename = sys.argv[1], sys.argv[2]
+    # optionally, the number of processes to validate with
+    processes = int(sys.argv[3]) if len(sys.argv) > 3 else 1
 
     print "Validating '%s' against schema '%s'..." % (data_filename, schema_filename),
 
     with open(data_filename) as data_json:
-        data = json.load(data_json, object_hook=decode_dict)
-
-    with open(schema_filename) as schema_json:
-        schema = json.load(schema_json)
+        data = load_json(data_json)
 
-    try:
-        validate(data, schema)
-    except exceptions.ValidationError as e:
+    errors = get_validation_errors(data, schema_filename, processes)
+    if errors:
         print "data does not match schema:"
-        print e
+        for error in errors:
+            print error
         sys.exit(1)
     else:
         print "success!"
@@ -10,7 +10,7 @@ setup(
     description="Library and utilities for Tango device configuration.",
     # Requirements
     setup_requires=['pytest-runner'],
-    install_requires=['jsonpatch>=1.13', 'PyTango'],
+    install_requires=['PyTango'],
     tests_require=["pytest", "pytest-cov", "fake-factory", "mock"],
     # Resources
     package_data={
@@ -5,11 +5,13 @@ try:
 except ImportError:
     from unittest import TestCase
 
-from dsconfig.configure import (update_server, update_device_or_class,
-                                update_properties)
+from dsconfig.configure import (as_caseless, configure, update_server,
+                                update_device_or_class,
+                                update_properties, TreeDigests)
 from dsconfig.formatting import CLASSES_LEVELS, SERVERS_LEVELS
 from dsconfig.utils import ObjectWrapper, find_device
 from dsconfig.appending_dict import AppendingDict
+from dsconfig.appending_dict.caseless import CaselessDictionary
 
 
 TEST_DATA = {
@@ -155,6 +157,46 @@ class ConfigureTestCase(TestCase):
 
         self.assertEqual(len(self.db.calls), 0)
 
+    def test_update_server_ignore_attribute_property_case(self):
+
+        "Test that attribute (property) names can be case insensitive"
+
+        dev = find_device(self.data, "sys/tg_test/2")[0]
+        dev["attribute_properties"] = {
+            "AMPLIZ": {"MIN_VALUE": ["100"], "Unit": ["hejsan"]}
+        }
+
+        update_server(self.db, "test",
+                      self.data["servers"]["TangoTest"]["test"],
+                      self.dbdict["servers"]["TangoTest"]["test"],
+                      ignore_case=True, difactory=Mock)
+
+        self.assertEqual(len(self.db.calls), 0)
+
+    def test_configure_ignore_server_and_instance_case(self):
+
+        "Test that server and instance names are caseless with ignore_case"
+
+        self.data["servers"]["tangotest"] = {
+            "TEST": self.data["servers"].pop("TangoTest")["test"]}
+        dev = find_device(self.data, "sys/tg_test/2")[0]
+        dev["properties"]["bepa"] = ["46"]
+
+        calls = configure(self.data, self.dbdict, ignore_case=True)
+
+        self.assertListEqual(
+            calls,
+            [('put_device_property', ('sys/tg_test/2', {'bepa': ['46']}), {})])
+        # ...but with case, it's a different server
+        calls = configure(self.data, self.dbdict)
+        self.assertEqual(calls[0][0], "add_device")
+
+    def test_as_caseless_converts_nested_levels(self):
+        data = as_caseless({"a": {"B": ["1"]}})
+        self.assertTrue(as_caseless(data) is data)
+        partly = CaselessDictionary({"a": {"B": ["1"]}})
+        self.assertEqual(as_caseless(partly)["A"]["b"], ["1"])
+
     def test_update_server_remove_property(self):
 
         dev = find_device(self.data, "sys/tg_test/2")[0]
@@ -407,3 +449,30 @@ class ConfigureTestCase(TestCase):
     #     self.assertListEqual(
     #         self.db.calls,
     #         [('put_device_property', ('sys/tg_test/2', {'bepa': ['573']}), {})])
+
+
+class TreeDigestsTestCase(TestCase):
+
+    def test_same(self):
+        digests = TreeDigests()
+        self.assertTrue(digests.same(deepcopy(TEST_DATA), deepcopy(TEST_DATA)))
+
+    def test_not_same(self):
+        digests = TreeDigests()
+        data = deepcopy(TEST_DATA)
+        find_device(data, "sys/tg_test/2")[0]["properties"]["bepa"] = ["46"]
+        self.assertFalse(digests.same(data, TEST_DATA))
+
+    def test_ignore_case(self):
+        data = deepcopy(TEST_DATA)
+        dev = find_device(data, "sys/tg_test/2")[0]
+        dev["properties"]["BEPA"] = dev["properties"].pop("bepa")
+        self.assertFalse(TreeDigests().same(data, TEST_DATA))
+        self.assertTrue(TreeDigests(ignore_case=True).same(data, TEST_DATA))
+
+    def test_values_keep_case(self):
+        data = deepcopy(TEST_DATA)
+        find_device(data, "sys/tg_test/2")[0]["properties"]["bepa"] = ["A"]
+        dbdata = deepcopy(TEST_DATA)
+        find_device(dbdata, "sys/tg_test/2")[0]["properties"]["bepa"] = ["a"]
+        self.assertFalse(TreeDigests(ignore_case=True).same(data, dbdata))
@@ -0,0 +1,41 @@
+from dsconfig.diff import iter_diff, print_diff
+from dsconfig.utils import yellow
+
+
+def test_iter_diff():
+    old = {
+        "servers": {
+            "TangoTest": {"test": {"TangoTest": {
+                "sys/tg_test/1": {
+                    "properties": {"a": ["1"], "B": ["2"], "c": ["3"]}
+                }}}}}}
+    new = {
+        "servers": {
+            "tangotest": {"test": {"TangoTest": {
+                "SYS/TG_TEST/1": {
+                    "properties": {"b": ["2"], "c": ["4", "5"], "d": []}
+                }}}}}}
+    ops = sorted(iter_diff(old, new), key=lambda op: op["path"])
+    path = "/servers/tangotest/test/TangoTest/SYS~1TG_TEST~11/properties"
+    assert ops == [
+        {"op": "remove", "path": path + "/a", "old_value": ["1"]},
+        {"op": "replace", "path": path + "/c", "value": ["4", "5"],
+         "old_value": ["3"]},
+        {"op": "add", "path": path + "/d", "value": []},
+    ]
+
+
+def test_iter_diff_case_sensitive():
+    ops = list(iter_diff({"a": {"B": ["1"]}}, {"a": {"b": ["1"]}},
+                         ignore_case=False))
+    assert sorted(op["op"] for op in ops) == ["add", "remove"]
+    assert not list(iter_diff({"a": {"B": ["1"]}}, {"a": {"b": ["1"]}}))
+
+
+def test_print_diff_returns_ops(capsys):
+    ops = print_diff({"a": {"b": ["1"]}}, {"a": {"b": ["2"]}})
+    assert ops == [{"op": "replace", "path": "/a/b",
+                    "value": ["2"], "old_value": ["1"]}]
+    # the path is printed the same way as before
+    out, _ = capsys.readouterr()
+    assert out.splitlines()[1] == yellow(" > a > b")
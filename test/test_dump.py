@@ -0,0 +1,169 @@
+import PyTango
+from mock import MagicMock
+
+from dsconfig.configure import configure
+from dsconfig.dump import filter_db_data, get_db_data, get_db_data_for_config
+from dsconfig.tangodb import summarise_calls
+
+
+def test_get_db_data_combines_patterns(monkeypatch):
+
+    dbproxy = MagicMock()
+    dbproxy.command_inout.return_value = ([], [])
+    monkeypatch.setattr(PyTango, "DeviceProxy", lambda name: dbproxy)
+
+    patterns = ["device:sys/tg_test/%d" % i for i in range(10)]
+    patterns.append("class:TangoTest")
+    get_db_data(MagicMock(), patterns, parallel=False)
+
+    # one query per table, regardless of the number of patterns
+    queries = [args[1] for args, _ in dbproxy.command_inout.call_args_list]
+    assert len(queries) == 3
+    for query in queries:
+        assert all(pattern.split(":")[1] in query for pattern in patterns)
+
+
+def test_get_db_data_for_config(monkeypatch):
+
+    dbproxy = MagicMock()
+    dbproxy.command_inout.return_value = ([], [])
+    monkeypatch.setattr(PyTango, "DeviceProxy", lambda name: dbproxy)
+
+    config = {
+        "servers": {
+            "TangoTest": {
+                "test": {
+                    "TangoTest": {
+                        "sys/tg_test/1": {}
+                    }}}},
+        "classes": {
+            "TangoTest": {
+                "properties": {"a": ["b"]}
+            }}}
+    get_db_data_for_config(MagicMock(), config, parallel=False)
+
+    queries = [args[1] for args, _ in dbproxy.command_inout.call_args_list]
+    assert len(queries) == 5
+    for query in queries[:3]:
+        # only the relevant server and devices
+        assert "device.server IN ('TangoTest/test')" in query
+        assert "device.name IN ('sys/tg_test/1')" in query
+        assert "LIKE" not in query
+    for query in queries[3:]:
+        assert "class IN ('TangoTest')" in query
+
+
+def test_get_db_data_for_config_chunks_names(monkeypatch):
+
+    names = ["sys/tg_test/%d" % i for i in range(2500)]
+
+    def command_inout(cmd, query):
+        if "FROM device" in query:
+            rows = [("TangoTest/test", "TangoTest", name, "")
+                    for name in names if "'%s'" % name in query]
+            return [], [value for row in rows for value in row]
+        return [], []
+
+    dbproxy = MagicMock()
+    dbproxy.command_inout.side_effect = command_inout
+    monkeypatch.setattr(PyTango, "DeviceProxy", lambda name: dbproxy)
+
+    config = {
+        "servers": {
+            "TangoTest": {
+                "test": {
+                    "TangoTest": dict((name, {}) for name in names)
+                }}}}
+    data = get_db_data_for_config(MagicMock(), config, parallel=False)
+
+    # three chunks of device names, three queries each
+    queries = [args[1] for args, _ in dbproxy.command_inout.call_args_list]
+    assert len(queries) == 3 * 3
+    for query in queries:
+        assert query.count("'sys/tg_test/") <= 1000
+    assert len(data["servers"]["TangoTest"]["test"]["TangoTest"]) == 2500
+
+
+def make_dbproxy(devices):
+    """Fake DB device that returns the given (server, class, device,
+    alias) rows for the device queries, and no properties"""
+
+    def command_inout(cmd, query):
+        if "FROM device" in query:
+            return [], [value for row in devices for value in row]
+        return [], []
+
+    dbproxy = MagicMock()
+    dbproxy.command_inout.side_effect = command_inout
+    return dbproxy
+
+
+def test_get_db_data_for_config_filtered(monkeypatch):
+
+    dbproxy = make_dbproxy([
+        ("TangoTest/test", "TangoTest", "sys/tg_test/1", ""),
+        ("TangoTest/test", "TangoTest", "sys/tg_test/2", ""),
+        ("TangoTest/test", "TangoTest", "sys/tg_test/3", ""),
+        ("OtherServer/1", "TangoTest", "sys/tg_test/4", ""),
+    ])
+    monkeypatch.setattr(PyTango, "DeviceProxy", lambda name: dbproxy)
+
+    # as if filtered with "-x device:.*/2"
+    config = {
+        "servers": {
+            "TangoTest": {
+                "test": {
+                    "TangoTest": {
+                        "sys/tg_test/1": {},
+                        "sys/tg_test/4": {}
+                    }}}}}
+    exclude = ["device:.*/2"]
+    data = get_db_data_for_config(MagicMock(), config, exclude=exclude,
+                                  parallel=False)
+
+    # the filter is used in the query for the properties...
+    query = dbproxy.command_inout.call_args_list[0][0][1]
+    assert "NOT (device.name REGEXP '^(.*/2)')" in query
+    # ...but the server instances are still complete
+    query = dbproxy.command_inout.call_args_list[-1][0][1]
+    assert "REGEXP" not in query
+    assert data["servers"]["TangoTest"]["test"]["TangoTest"] == {
+        "sys/tg_test/1": {}, "sys/tg_test/2": {}, "sys/tg_test/3": {}}
+
+    # only the filtered part is compared; devices in the config are kept
+    assert filter_db_data(data, config, exclude=exclude)["servers"] == {
+        "TangoTest": {"test": {"TangoTest": {"sys/tg_test/1": {},
+                                             "sys/tg_test/3": {}}}},
+        "OtherServer": {"1": {"TangoTest": {"sys/tg_test/4": {}}}}
+    }
+
+
+def test_get_db_data_for_config_filtered_existing_instance(monkeypatch):
+
+    dbproxy = make_dbproxy([
+        ("TangoTest/test", "DServer", "dserver/TangoTest/test", ""),
+        ("TangoTest/test", "TangoTest", "sys/tg_test/1", ""),
+    ])
+    monkeypatch.setattr(PyTango, "DeviceProxy", lambda name: dbproxy)
+
+    # as if filtered with "-i device:sys/tg_test/2"
+    config = {
+        "servers": {
+            "TangoTest": {
+                "test": {
+                    "TangoTest": {
+                        "sys/tg_test/2": {}
+                    }}}}}
+    include = ["device:sys/tg_test/2"]
+    original = get_db_data_for_config(MagicMock(), config, include=include,
+                                      parallel=False)
+    assert original["servers"]["TangoTest"]["test"] == {
+        "DServer": {"dserver/TangoTest/test": {}},
+        "TangoTest": {"sys/tg_test/1": {}}}
+
+    dbdata = filter_db_data(original, config, include=include)
+    calls = configure(config, dbdata)
+    assert [method for method, _, _ in calls] == ["add_device"]
+    # the server already exists, it's just a new device
+    summary = summarise_calls(calls, original)
+    assert "Add 1 servers." not in "\n".join(summary)
@@ -0,0 +1,118 @@
+import time
+
+import PyTango
+from mock import Mock
+
+from dsconfig.execute import (coalesce_calls, execute_calls, group_calls,
+                              Throttle)
+
+
+def test_coalesce_calls_merges_properties():
+    calls = [
+        ("put_device_property", ("a/b/c", {"a": ["1"]}), {}),
+        ("put_device_property", ("A/B/C", {"b": ["2"], "a": ["3"]}), {}),
+        ("put_device_property", ("d/e/f", {"a": ["1"]}), {}),
+    ]
+    assert coalesce_calls(calls) == [
+        ("put_device_property", ("a/b/c", {"a": ["3"], "b": ["2"]}), {}),
+        ("put_device_property", ("d/e/f", {"a": ["1"]}), {}),
+    ]
+    # the original calls are left alone
+    assert calls[0] == ("put_device_property", ("a/b/c", {"a": ["1"]}), {})
+
+
+def test_coalesce_calls_merges_attribute_properties():
+    calls = [
+        ("put_device_attribute_property",
+         ("a/b/c", {"attr": {"unit": ["V"]}}), {}),
+        ("put_device_attribute_property",
+         ("a/b/c", {"attr": {"format": ["%d"]}, "attr2": {"unit": ["A"]}}),
+         {}),
+    ]
+    assert coalesce_calls(calls) == [
+        ("put_device_attribute_property",
+         ("a/b/c", {"attr": {"unit": ["V"], "format": ["%d"]},
+                    "attr2": {"unit": ["A"]}}), {})
+    ]
+
+
+def test_coalesce_calls_keeps_order_per_target():
+    calls = [
+        ("put_device_property", ("a/b/c", {"a": ["1"]}), {}),
+        ("delete_device_property", ("a/b/c", {"a": ["1"]}), {}),
+        ("put_device_property", ("a/b/c", {"a": ["2"]}), {}),
+    ]
+    assert coalesce_calls(calls) == calls
+
+
+def test_coalesce_calls_keeps_keyword_arguments():
+    calls = [
+        ("put_device_property", ("a/b/c", {"a": ["1"]}), {"extra": 1}),
+        ("put_device_property", ("a/b/c", {"b": ["2"]}), {}),
+    ]
+    assert coalesce_calls(calls) == calls
+
+
+def test_throttle_only_delays_when_db_slows_down():
+    throttle = Throttle(smoothing=1.0, tolerance=2.0)
+    assert throttle.get_delay() == 0
+    throttle.record(0.01)
+    throttle.record(0.015)
+    assert throttle.get_delay() == 0
+    throttle.record(0.05)
+    assert abs(throttle.get_delay() - 0.03) < 1e-9
+
+
+def test_execute_calls():
+    db = Mock()
+    calls = [
+        ("put_device_property", ("a/b/c", {"a": ["1"]}), {}),
+        ("put_device_property", ("a/b/c", {"b": ["2"]}), {}),
+        ("delete_device", ("d/e/f",), {}),
+    ]
+    execute_calls(db, calls, sleep=0)
+    db.put_device_property.assert_called_once_with(
+        "a/b/c", {"a": ["1"], "b": ["2"]})
+    db.delete_device.assert_called_once_with("d/e/f")
+
+
+def test_execute_calls_in_parallel_skips_after_failure():
+    db = Mock()
+    error = PyTango.DevFailed()
+    db.add_device.side_effect = error
+    info = Mock()
+    info.name = "a/b/c"
+    calls = [
+        ("add_device", (info,), {}),
+        ("put_device_property", ("a/b/c", {"a": ["1"]}), {}),
+        ("put_device_property", ("d/e/f", {"a": ["1"]}), {}),
+        ("put_class_property", ("SomeClass", {"b": ["2"]}), {}),
+    ]
+    failed, skipped = execute_calls(db, calls, sleep=0, workers=3,
+                                    db_factory=lambda: db)
+    assert failed == [(calls[0], error)]
+    assert skipped == [calls[1]]
+    db.put_device_property.assert_called_once_with("d/e/f", {"a": ["1"]})
+    db.put_class_property.assert_called_once_with("SomeClass", {"b": ["2"]})
+
+
+def test_execute_calls_in_parallel_moves_alias():
+    db = Mock()
+    done = []
+
+    def delete_device_alias(alias):
+        time.sleep(0.05)  # give a put a chance to overtake
+        done.append(("delete", alias))
+    db.delete_device_alias.side_effect = delete_device_alias
+    db.put_device_alias.side_effect = (
+        lambda device, alias: done.append(("put", device, alias)))
+    calls = [
+        ("delete_device_alias", ("my_alias",), {}),
+        ("put_device_property", ("a/b/c", {"a": ["1"]}), {}),
+        ("put_device_alias", ("d/e/f", "My_Alias"), {}),
+    ]
+    assert len(group_calls(calls)) == 2
+    failed, skipped = execute_calls(db, calls, sleep=0, workers=3,
+                                    db_factory=lambda: db)
+    assert failed == skipped == []
+    assert done == [("delete", "my_alias"), ("put", "d/e/f", "My_Alias")]
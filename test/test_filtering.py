@@ -3,7 +3,7 @@ try:
 except ImportError:
     from unittest import TestCase
 
-from dsconfig.filtering import filter_config
+from dsconfig.filtering import compile_pattern, filter_config
 from dsconfig.formatting import CLASSES_LEVELS, SERVERS_LEVELS
 
 
@@ -171,3 +171,96 @@ class FilterTestCase(TestCase):
         print(json.dumps(filtered, indent=4))
         print(json.dumps(expected, indent=4))
         self.assertEqual(filtered, expected)
+
+    def test_filter_json_include_and_exclude(self):
+        data = {
+            "TangoTest": {
+                "test": {
+                    "TangoTest": {
+                        "sys/tg_test/3": {},
+                        "sys/tg_test/4": {}
+                    }
+                },
+                "test2": {
+                    "TangoTest": {
+                        "sys/tg_test/5": {}
+                    }
+                }
+            },
+            "OtherServer": {
+                "1": {
+                    "OtherServer": {
+                        "a/b/c": {}
+                    }
+                }
+            }
+        }
+        expected = {
+            "TangoTest": {
+                "test": {
+                    "TangoTest": {
+                        "sys/tg_test/3": {}
+                    }
+                }
+            }
+        }
+        filtered = filter_config(data, ["server:tangotest"], SERVERS_LEVELS,
+                                 excludes=["device:.*/4$", "device:.*/5$"])
+        self.assertEqual(filtered, expected)
+        # the untouched parts are not copied
+        self.assertTrue(filtered["TangoTest"]["test"]["TangoTest"]
+                        ["sys/tg_test/3"]
+                        is data["TangoTest"]["test"]["TangoTest"]
+                        ["sys/tg_test/3"])
+        # the same, only using inverted filters
+        filtered = filter_config(data, ["server:Other", "device:.*/4$"],
+                                 SERVERS_LEVELS, invert=True,
+                                 excludes=["server:TangoTest/test2"])
+        self.assertEqual(filtered, expected)
+
+    def test_filter_json_include_instance(self):
+        data = {
+            "TangoTest": {
+                "test": {"TangoTest": {"sys/tg_test/3": {}}},
+                "test2": {"TangoTest": {"sys/tg_test/4": {}}}
+            },
+            "OtherServer": {
+                "test": {"OtherServer": {"a/b/c": {}}}
+            }
+        }
+        filtered = filter_config(data, ["server:TangoTest/test$"],
+                                 SERVERS_LEVELS)
+        self.assertEqual(
+            filtered, {"TangoTest": {"test": data["TangoTest"]["test"]}})
+
+    def test_filter_json_bad_filter(self):
+        self.assertRaises(ValueError, filter_config, {}, ["apa:.*"],
+                          SERVERS_LEVELS)
+        self.assertRaises(ValueError, filter_config, {}, ["device:("],
+                          SERVERS_LEVELS)
+
+    def test_filter_json_exact_device(self):
+        data = {
+            "TangoTest": {
+                "test": {
+                    "TangoTest": dict(("sys/tg_test/%d" % i, {})
+                                      for i in range(20))
+                }
+            }
+        }
+        filtered = filter_config(data, ["device:SYS/tg_test/1$"],
+                                 SERVERS_LEVELS)
+        self.assertEqual(filtered, {"TangoTest": {"test": {"TangoTest": {
+            "sys/tg_test/1": {}}}}})
+        filtered = filter_config(data, ["device:sys/tg_test/1"],
+                                 SERVERS_LEVELS)
+        self.assertEqual(
+            sorted(filtered["TangoTest"]["test"]["TangoTest"]),
+            ["sys/tg_test/1"] + ["sys/tg_test/1%d" % i for i in range(10)])
+
+    def test_compile_pattern(self):
+        pattern = compile_pattern("sys/tg_test/1$")
+        self.assertTrue(pattern is compile_pattern("sys/tg_test/1$"))
+        self.assertTrue(pattern.match("SYS/TG_TEST/1"))
+        self.assertFalse(pattern.match("sys/tg_test/10"))
+        self.assertTrue(compile_pattern("sys/tg_.*").match("SYS/TG_TEST/1"))
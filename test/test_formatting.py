@@ -0,0 +1,83 @@
+from StringIO import StringIO
+
+from mock import Mock
+import PyTango
+
+from dsconfig import tangodb
+from dsconfig.formatting import (expand_config, get_validation_errors,
+                                 load_json, normalize_config)
+
+
+def test_load_json_encodes_strings():
+    f = StringIO('{"servers": {"S\\u00e4rver": {"a": ["b", ["c"], {"d": "e"}]},'
+                 ' "b": 1}}')
+    data = load_json(f)
+    assert data == {"servers": {"S\xc3\xa4rver": {"a": ["b", ["c"], {"d": "e"}]},
+                                "b": 1}}
+    server = data["servers"]["S\xc3\xa4rver"]
+    assert type(server.keys()[0]) == str
+    assert type(server["a"][0]) == str
+    assert type(server["a"][1][0]) == str
+    assert type(server["a"][2].values()[0]) == str
+
+
+def test_expand_config_leaves_original_alone():
+    config = {"servers": {"TangoTest/1": {"TangoTest": {"a/b/c": {}}},
+                          "TangoTest": {"2": {"TangoTest": {"d/e/f": {}}}}}}
+    expanded = expand_config(config)
+    assert expanded == {"servers": {"TangoTest": {
+        "1": {"TangoTest": {"a/b/c": {}}},
+        "2": {"TangoTest": {"d/e/f": {}}}}}}
+    assert "TangoTest/1" in config["servers"]
+    assert config["servers"]["TangoTest"].keys() == ["2"]
+    # the device configs are shared, not copied
+    assert (expanded["servers"]["TangoTest"]["1"]
+            is config["servers"]["TangoTest/1"])
+
+
+def test_normalize_config_devices(monkeypatch):
+    dbproxy = Mock()
+    dbproxy.command_inout.return_value = (
+        None, ["TangoTest/1", "TangoTest", "a/b/c", "",
+               "TangoTest/1", "TangoTest", "d/e/f", ""])
+    monkeypatch.setattr(PyTango, "Database", Mock)
+    monkeypatch.setattr(PyTango, "DeviceProxy", lambda name: dbproxy)
+    monkeypatch.setattr(tangodb, "_device_info_cache", {})
+    props = {"properties": {"a": ["1"]}}
+    config = {
+        "_title": "test",
+        "servers": {"tangotest/1": {"TangoTest": {"A/B/C": {}}}},
+        "devices": {"a/b/c": props, "d/e/f": props}
+    }
+    normalized = normalize_config(config)
+    assert normalized == {"servers": {"tangotest": {"1": {"TangoTest": {
+        "A/B/C": props, "d/e/f": props}}}}}
+    assert config["servers"] == {"tangotest/1": {"TangoTest": {"A/B/C": {}}}}
+
+    # the devices are only looked up once
+    assert dbproxy.command_inout.call_count == 1
+
+    normalized = normalize_config(config, inplace=True)
+    assert config["servers"] is normalized["servers"]
+    assert dbproxy.command_inout.call_count == 1
+
+
+def test_get_validation_errors_reports_all_errors():
+    config = {
+        "servers": {
+            "TangoTest": {"1": {"TangoTest": {
+                "a/b/c": {"properties": {"a": [1]}},
+                "bad": {}}}},
+            "bad?": {}
+        },
+        "classes": {"TangoTest": {"properties": {"b": "c"}}},
+    }
+    errors = get_validation_errors(config)
+    assert len(errors) == 4
+    assert errors[0].startswith("servers: 'bad?'")
+    assert errors[1].startswith("servers > TangoTest > 1 > TangoTest: 'bad'")
+    assert errors[2].startswith(
+        "servers > TangoTest > 1 > TangoTest > a/b/c > properties > a > 0: ")
+    assert errors[3].startswith("classes > TangoTest > properties > b: ")
+    assert get_validation_errors(config, processes=2) == errors
+    assert get_validation_errors({"servers": {}}) == []
@@ -0,0 +1,86 @@
+import json
+import sys
+
+import PyTango
+from mock import MagicMock
+
+from dsconfig import json2tango
+
+
+def test_changes_json_to_stdout_with_write(tmpdir, monkeypatch, capsys):
+
+    dbdata = {
+        "servers": {
+            "TangoTest": {
+                "test": {
+                    "TangoTest": {
+                        "sys/tg_test/1": {"properties": {"a": ["1"]}}
+                    }}}}}
+    config = {
+        "servers": {
+            "TangoTest": {
+                "test": {
+                    "TangoTest": {
+                        "sys/tg_test/1": {"properties": {"a": ["2"]}},
+                        "sys/tg_test/2": {"properties": {"b": ["3"]}}
+                    }}}}}
+    dbfile = tmpdir.join("db.json")
+    dbfile.write(json.dumps(dbdata))
+    configfile = tmpdir.join("config.json")
+    configfile.write(json.dumps(config))
+
+    db = MagicMock()
+    db.get_device_class_list.return_value = []
+    monkeypatch.setattr(PyTango, "Database", lambda: db)
+    monkeypatch.setattr(sys, "argv", [
+        "json2tango", "-w", "-v", "--changes-json", "-",
+        "-D", str(dbfile), str(configfile)])
+
+    json2tango.main()
+
+    # nothing else (e.g. the progress bar) gets mixed into the stream
+    out, _ = capsys.readouterr()
+    changes = [json.loads(line) for line in out.splitlines()]
+    assert [change["device"] for change in changes] == [
+        "sys/tg_test/1", "sys/tg_test/2"]
+    assert db.put_device_property.call_count == 2
+
+
+def test_filtered_output_leaves_out_devices_without_properties(
+        tmpdir, monkeypatch, capsys):
+
+    def command_inout(cmd, query):
+        if "FROM device" in query:
+            rows = [("TangoTest/test", "TangoTest", "sys/tg_test/1", ""),
+                    ("TangoTest/test", "TangoTest", "sys/tg_test/2", "")]
+        elif "FROM property_device" in query:
+            # the properties of /2 are not read, because of the filter
+            rows = [("sys/tg_test/1", "a", "1")]
+        else:
+            rows = []
+        return [], [value for row in rows for value in row]
+
+    dbproxy = MagicMock()
+    dbproxy.command_inout.side_effect = command_inout
+    monkeypatch.setattr(PyTango, "DeviceProxy", lambda name: dbproxy)
+    monkeypatch.setattr(PyTango, "Database", MagicMock)
+
+    config = {
+        "servers": {
+            "TangoTest": {
+                "test": {
+                    "TangoTest": {
+                        "sys/tg_test/1": {"properties": {"a": ["2"]}}
+                    }}}}}
+    configfile = tmpdir.join("config.json")
+    configfile.write(json.dumps(config))
+    monkeypatch.setattr(sys, "argv", [
+        "json2tango", "-q", "-v", "-o", "-x", "device:.*/2",
+        str(configfile)])
+
+    json2tango.main()
+
+    out, _ = capsys.readouterr()
+    assert json.loads(out)["servers"] == {
+        "TangoTest": {"test": {"TangoTest": {
+            "sys/tg_test/1": {"properties": {"a": ["1"]}}}}}}
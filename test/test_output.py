@@ -0,0 +1,126 @@
+import json
+from StringIO import StringIO
+
+from mock import Mock
+
+from dsconfig.output import (get_changes, property_diff, show_actions,
+                             write_changes)
+from dsconfig.utils import green, red
+
+
+def test_get_changes():
+    data = {
+        "servers": {
+            "TangoTest": {
+                "test": {
+                    "TangoTest": {
+                        "sys/tg_test/1": {
+                            "properties": {"a": ["1"], "b": ["2"]},
+                            "attribute_properties": {
+                                "Attr": {"unit": ["V"]}
+                            }
+                        },
+                        "sys/tg_test/2": {
+                            "properties": {"c": ["3"]}
+                        }
+                    }
+                }
+            }
+        },
+        "classes": {
+            "TangoTest": {
+                "attribute_properties": {"attr": {"format": ["%d"]}}
+            }
+        }
+    }
+    info = Mock(server="TangoTest/other", _class="TangoTest")
+    info.name = "sys/tg_test/2"
+    calls = [
+        ("put_device_property", ("SYS/TG_TEST/1", {"A": ["1"], "b": ["3"]}),
+         {}),
+        ("put_device_attribute_property",
+         ("sys/tg_test/1", {"attr": {"unit": ["A"], "format": ["%f"]}}), {}),
+        ("add_device", (info,), {}),
+        ("delete_class_attribute_property",
+         ("tangotest", {"Attr": ["format"]}), {}),
+    ]
+    changes = get_changes(data, calls)
+    assert changes["devices"] == {
+        "SYS/TG_TEST/1": {
+            "properties": {"b": {"old_value": ["2"], "value": ["3"]}},
+            "attribute_properties": {
+                "attr": {"unit": {"old_value": ["V"], "value": ["A"]},
+                         "format": {"old_value": None, "value": ["%f"]}}}
+        },
+        "sys/tg_test/2": {
+            "added": True, "server": "TangoTest/other",
+            "device_class": "TangoTest",
+            "old_server": "TangoTest/test", "old_class": "TangoTest"
+        }
+    }
+    assert changes["classes"] == {
+        "tangotest": {
+            "attribute_properties": {
+                "Attr": {"format": {"old_value": ["%d"]}}}
+        }
+    }
+
+
+def test_show_actions():
+    data = {
+        "servers": {
+            "TangoTest": {
+                "test": {
+                    "TangoTest": {
+                        "sys/tg_test/1": {"properties": {"a": ["1"]}}
+                    }
+                }
+            }
+        }
+    }
+    calls = [
+        ("put_device_property",
+         ("sys/tg_test/2", {"b": [str(i) for i in range(20)]}), {}),
+        ("put_device_property", ("sys/tg_test/1", {"a": ["2"]}), {}),
+    ]
+    out = StringIO()
+    show_actions(data, calls, out=out, max_lines=5)
+    lines = out.getvalue().splitlines()
+    # the devices come in order, each one cut off after 5 lines
+    assert "sys/tg_test/1" in lines[0]
+    assert lines[5] == ""
+    assert "sys/tg_test/2" in lines[6]
+    assert lines[11].endswith("  ... [9 more lines]")
+    assert len(lines) == 13
+
+
+def test_write_changes():
+    data = {
+        "classes": {"TangoTest": {"properties": {"a": ["1"]}}}
+    }
+    calls = [
+        ("put_device_property", ("sys/tg_test/1", {"a": ["2"]}), {}),
+        ("delete_class_property", ("TangoTest", ["a"]), {}),
+    ]
+    out = StringIO()
+    write_changes(data, calls, out)
+    lines = out.getvalue().splitlines()
+    assert [json.loads(line) for line in lines] == [
+        {"device": "sys/tg_test/1",
+         "changes": {"properties": {"a": {"old_value": None,
+                                          "value": ["2"]}}}},
+        {"class": "TangoTest",
+         "changes": {"properties": {"a": {"old_value": ["1"]}}}},
+    ]
+
+
+def test_property_diff():
+    old = ["a", "b", "c", "d"]
+    new = ["a", "x", "c", "d", "e"]
+    assert property_diff(old, new).split("\n") == [
+        "  a", red("- b"), green("+ x"), "  c", "  d", green("+ e")]
+    # without ndiff, the changed lines are removed and added as a block
+    assert property_diff(old, new, max_ndiff_lines=2).split("\n") == [
+        "  a", red("- b"), red("- c"), red("- d"),
+        green("+ x"), green("+ c"), green("+ d"), green("+ e")]
+    assert property_diff(["a"], ["a"]) == "  a"
@@ -0,0 +1,36 @@
+import json
+
+import PyTango
+from mock import MagicMock
+
+from dsconfig import remove
+
+
+def test_remove_uses_bulk_queries(tmpdir, monkeypatch):
+
+    def command_inout(cmd, query):
+        if "FROM device" in query:
+            return [], ["TangoTest/test", "TangoTest", "sys/tg_test/1", ""]
+        return [], []
+
+    dbproxy = MagicMock()
+    dbproxy.command_inout.side_effect = command_inout
+    db = MagicMock()
+    monkeypatch.setattr(PyTango, "DeviceProxy", lambda name: dbproxy)
+    monkeypatch.setattr(PyTango, "Database", lambda: db)
+
+    config = tmpdir.join("config.json")
+    config.write(json.dumps({
+        "servers": {
+            "TangoTest": {
+                "test": {
+                    "TangoTest": {
+                        "sys/tg_test/1": {},
+                        "sys/tg_test/2": {}
+                    }}}}}))
+    remove.main(str(config), write=True)
+
+    # the DB is read with a fixed number of queries, not per device
+    assert dbproxy.command_inout.call_count == 3
+    db.delete_device.assert_called_once_with("sys/tg_test/1")
+    db.delete_server.assert_called_once_with("TangoTest/test")
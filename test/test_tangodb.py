@@ -1,6 +1,8 @@
 import PyTango
 import pytest
-from dsconfig.tangodb import get_dict_from_db
+from dsconfig.tangodb import (filters_condition, get_dict_from_db,
+                              get_dict_from_db_bulk, regex_condition,
+                              get_servers_with_filters)
 from dsconfig.utils import ObjectWrapper, find_device
 from mock import MagicMock, create_autospec
 
@@ -54,3 +56,136 @@ def test_get_dict_from_db():
 
     db = make_db(dbdata)
     print get_dict_from_db(db, indata)
+
+
+def make_dbproxy(devices, properties, class_properties=()):
+    """Fake DB device that answers the DbMySqlSelect queries made by
+    get_servers_with_filters, from lists of result rows."""
+    dbproxy = MagicMock()
+    queries = []
+
+    def command_inout(cmd, query):
+        queries.append(query)
+        if "FROM property_device" in query:
+            rows = [row for row in properties
+                    if "IN (" not in query or "'%s'" % row[0] in query]
+        elif "FROM property_attribute_device" in query:
+            rows = []
+        elif "FROM property_class" in query:
+            rows = class_properties
+        elif "FROM property_attribute_class" in query:
+            rows = []
+        else:
+            rows = devices
+            if "LIMIT" in query:
+                limit, offset = [int(w) for w in query.split()[-3::2]]
+                rows = rows[offset:offset+limit]
+        return [], [value for row in rows for value in row]
+    dbproxy.command_inout.side_effect = command_inout
+
+    return dbproxy, queries
+
+
+def test_get_servers_with_filters_paged():
+
+    devices = [("TangoTest/%d" % i, "TangoTest", "sys/tg_test/%d" % i, "")
+               for i in range(5)]
+    properties = [("sys/tg_test/%d" % i, "a", str(i)) for i in range(5)]
+    dbproxy, queries = make_dbproxy(devices, properties)
+
+    servers = get_servers_with_filters(dbproxy, page_size=2,
+                                       parallel=False).to_dict()
+
+    assert len(queries) == 3 * 3  # three pages, three queries each
+    for i in range(5):
+        device = servers["TangoTest"][str(i)]["TangoTest"]["sys/tg_test/%d" % i]
+        assert device == {"properties": {"a": [str(i)]}}
+
+
+def test_get_servers_with_filters_parallel(monkeypatch):
+
+    devices = [("TangoTest/1", "TangoTest", "sys/tg_test/1", "my_alias")]
+    properties = [("sys/tg_test/1", "a", "b")]
+    dbproxy, queries = make_dbproxy(devices, properties)
+    # each worker thread creates its own proxy
+    monkeypatch.setattr(PyTango, "DeviceProxy", lambda name: dbproxy)
+
+    servers = get_servers_with_filters(dbproxy).to_dict()
+
+    assert len(queries) == 3
+    device = servers["TangoTest"]["1"]["TangoTest"]["sys/tg_test/1"]
+    assert device == {"alias": "my_alias", "properties": {"a": ["b"]}}
+
+
+def test_get_dict_from_db_bulk():
+
+    indata = {
+        "servers": {
+            "TangoTest": {
+                "1": {
+                    "TangoTest": {
+                        "sys/tg_test/1": {},
+                        "sys/tg_test/2": {}
+                    }}}},
+        "classes": {
+            "TangoTest": {
+                "properties": {
+                    "a": ["1"]
+                }}}}
+
+    devices = [("TangoTest/1", "TangoTest", "sys/tg_test/1", ""),
+               ("TangoTest/2", "TangoTest", "sys/tg_test/2", "")]
+    properties = [("sys/tg_test/1", "a", "b"),
+                  ("sys/tg_test/1", "polled_attr", "c")]
+    class_properties = [("TangoTest", "a", "2"), ("TangoTest", "b", "3")]
+    dbproxy, queries = make_dbproxy(devices, properties, class_properties)
+
+    dbdict, moved = get_dict_from_db_bulk(dbproxy, indata, parallel=False)
+
+    assert len(queries) == 5
+    assert dbdict == {
+        "servers": {
+            "TangoTest": {
+                "1": {
+                    "TangoTest": {
+                        "sys/tg_test/1": {
+                            "properties": {"a": ["b"]}
+                        }}}}},
+        "classes": {
+            "TangoTest": {
+                "properties": {"a": ["2"]}
+            }}}
+    assert moved == {"TangoTest/2": [("TangoTest", "sys/tg_test/2")]}
+
+
+def test_filters_condition():
+    levels = {"server": 0, "class": 2, "device": 3, "property": 5}
+    assert filters_condition(["server:TangoTest/1"], [], levels) == (
+        "((SUBSTRING_INDEX(device.server, '/', 1) LIKE 'TangoTest%'"
+        " AND SUBSTRING_INDEX(device.server, '/', -1) LIKE '1%'))")
+    assert filters_condition(["class:Tango", "device:a_b/.*"],
+                             ["device:.*\\d"], levels) == (
+        "((device.class LIKE 'Tango%') OR (device.name REGEXP '^(a_b/.*)'))")
+    # an include filter that can't be translated means all are dropped
+    assert filters_condition(["class:Tango", "property:a"],
+                             ["device:(?i)a"], levels) is None
+
+
+def test_regex_condition_only_when_exact():
+    assert regex_condition("device.name", "a.*") == (
+        "device.name REGEXP '^(a.*)'")
+    # python and (older) MySQL don't agree on these
+    for regex in ["a|", "a|b", "a{,3}", "a{2}", "a()b", "[[:alpha:]]",
+                  "a[[.-.]]", "[[=a=]]b"]:
+        assert regex_condition("device.name", regex) is None
+    assert regex_condition("device.name", "a[0-9]") == (
+        "device.name REGEXP '^(a[0-9])'")
+
+
+def test_filters_condition_leaves_out_inexact_excludes():
+    levels = {"server": 0, "class": 2, "device": 3}
+    assert filters_condition(["class:Tango"], ["device:a|", "device:a{,3}"],
+                             levels) == "((device.class LIKE 'Tango%'))"
+    assert filters_condition([], ["device:a|b", "device:[[.-.]]",
+                                  "device:x/.*"], levels) == (
+        "(NOT (device.name REGEXP '^(x/.*)'))")